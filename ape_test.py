@@ -1,14 +1,1493 @@
+import io
 import os
 import re
+import zlib
+import csv
+import json
+import queue
+import sqlite3
+import time
+import asyncio
+import multiprocessing
+import threading
+import glob
+import fnmatch
+import shutil
+import tempfile
+import hashlib
+import zipfile
 import argparse
+import openpyxl
+import numpy as np
 import pandas as pd
+from pypdf import PdfReader
 from pathlib import Path
+from itertools import chain
+from collections import deque, namedtuple
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+
+XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+
+# Inline elements of TMX and XLIFF segments whose content is part of the text,
+# the other inline elements hold formatting codes
+INLINE_TEXT_TAGS = {"hi", "g", "mrk", "pc"}
+
+# MinHash parameters for near-duplicate detection: 128 permutations split into 16 LSH bands of 8 rows,
+# drawn from a fixed seed so signatures stored in the manifest stay comparable across runs
+MINHASH_PERMUTATIONS = 128
+MINHASH_BANDS = 16
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MINHASH_A, MINHASH_B = np.random.default_rng(1).integers(1, 1 << 32, size=(2, MINHASH_PERMUTATIONS), dtype=np.uint64)
+
+# Spreadsheets whose converted sheets are read as glossaries, with one column per language
+# headed by a language code such as "en", "fr-FR" or "pt_BR"
+GLOSSARY_SUFFIXES = {".xlsx", ".xls", ".csv"}
+LANGUAGE_HEADER = re.compile(r"^[a-z]{2}(?:[-_][a-z]{2,4})?$", re.IGNORECASE)
+
+# Two-letter headers that name row identifiers far more often than languages
+NON_LANGUAGE_HEADERS = {"id", "no"}
+
+# Translation memories whose converted segments are kept for fuzzy matching
+TM_SUFFIXES = {".tmx", ".xliff", ".xlf"}
+
+# Plain text files, converted files included, which can be compared and chunked locally
+TEXT_SUFFIXES = {".txt", ".md"}
+
+# Limits of a single Batch API job: number of requests and size of its input file
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_BYTES = 200 * 1000 * 1000
+
+def local_name(tag):
+    # Strip the XML namespace from a tag
+    return tag.rsplit("}", 1)[-1]
+
+def inline_text(elem):
+    parts = [elem.text or ""]
+    for child in elem:
+        if local_name(child.tag) in INLINE_TEXT_TAGS:
+            parts.append(inline_text(child))
+        parts.append(child.tail or "")
+    return "".join(parts)
+
+def normalize_segment(text):
+    # Collapse whitespace so a segment always fits in one TSV cell
+    return " ".join(text.split())
+
+def tsv_line(values):
+    buffer = io.StringIO()
+    csv.writer(buffer, delimiter="\t", lineterminator="\n").writerow(values)
+    return buffer.getvalue()
+
+def single_part(path):
+    return [None]
+
+def list_excel_sheets(path):
+    # Opening a workbook only reads its sheet index
+    with pd.ExcelFile(path) as xls:
+        return xls.sheet_names
+
+def iter_excel_lines(path, sheet_name, options):
+    if not options.get("streaming") or path.suffix.lower() != ".xlsx":
+        df = pd.read_excel(path, sheet_name=sheet_name)
+        yield df.to_csv(sep='\t', index=False)
+        return
+
+    # Read large sheets row by row in read-only mode, so memory use does not depend on their size
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in workbook[sheet_name].iter_rows(values_only=True):
+            # Skip blank rows like pandas does
+            if all(value is None for value in row):
+                continue
+            yield tsv_line("" if value is None else value for value in row)
+    finally:
+        workbook.close()
+
+def iter_csv_lines(path, part, options):
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        # Guess the delimiter from the beginning of the file
+        try:
+            dialect = csv.Sniffer().sniff(f.read(64 * 1024), delimiters=",;\t|")
+        except csv.Error:
+            dialect = csv.excel
+        f.seek(0)
+        for row in csv.reader(f, dialect):
+            if any(row):
+                yield tsv_line(row)
+
+def iter_docx_lines(path, part, options):
+    w = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+    with zipfile.ZipFile(path) as archive, archive.open("word/document.xml") as document:
+        parts = []
+        in_tab_stops = False
+        for event, elem in ElementTree.iterparse(document, events=("start", "end")):
+            # Tab stop definitions use the same tag as tab characters
+            if elem.tag == w + "tabs":
+                in_tab_stops = event == "start"
+            if event != "end":
+                continue
+            if elem.tag == w + "t":
+                parts.append(elem.text or "")
+            elif elem.tag == w + "tab" and not in_tab_stops:
+                parts.append("\t")
+            elif elem.tag in (w + "br", w + "cr"):
+                parts.append("\n")
+            elif elem.tag == w + "p":
+                # One line per paragraph
+                text = "".join(parts).strip()
+                parts = []
+                elem.clear()
+                if text:
+                    yield text + "\n"
+
+def iter_tmx_lines(path, part, options):
+    languages = None
+    for event, elem in ElementTree.iterparse(path, events=("end",)):
+        if local_name(elem.tag) != "tu":
+            continue
+
+        # Collect the segment of each language of the translation unit
+        segments = {}
+        for tuv in elem:
+            if local_name(tuv.tag) != "tuv":
+                continue
+            language = (tuv.get(XML_LANG) or tuv.get("lang") or "").lower()
+            for seg in tuv:
+                if local_name(seg.tag) == "seg" and language:
+                    segments[language] = normalize_segment(inline_text(seg))
+        elem.clear()
+        if not segments:
+            continue
+
+        # The languages of the first unit give the columns of the whole file
+        if languages is None:
+            languages = list(segments)
+            yield "\t".join(languages) + "\n"
+        yield "\t".join(segments.get(language, "") for language in languages) + "\n"
+
+def iter_xliff_segments(path):
+    source_language = ""
+    target_language = ""
+    unit_id = None
+    number = 0
+    for event, elem in ElementTree.iterparse(path, events=("start", "end")):
+        name = local_name(elem.tag)
+
+        # XLIFF 1.2 declares languages on <file>, XLIFF 2 on <xliff>
+        if event == "start":
+            if name in ("xliff", "file"):
+                source_language = elem.get("srcLang") or elem.get("source-language") or source_language
+                target_language = elem.get("trgLang") or elem.get("target-language") or target_language
+            elif name == "unit":
+                unit_id = elem.get("id")
+            continue
+
+        # XLIFF 1.2 units are <trans-unit>, XLIFF 2 units hold one or more <segment>
+        if name not in ("trans-unit", "segment"):
+            continue
+        number += 1
+        segment_id = elem.get("id")
+        if name == "segment" and unit_id:
+            segment_id = f"{unit_id}/{segment_id}" if segment_id else unit_id
+        source = ""
+        target = ""
+        for child in elem:
+            if local_name(child.tag) == "source":
+                source = normalize_segment(inline_text(child))
+            elif local_name(child.tag) == "target":
+                target = normalize_segment(inline_text(child))
+        elem.clear()
+        if not source:
+            continue
+        yield {
+            "id": segment_id or str(number),
+            "source": source,
+            "target": target,
+            "source_language": source_language,
+            "target_language": target_language,
+        }
+
+def iter_xliff_lines(path, part, options):
+    header_written = False
+    for segment in iter_xliff_segments(path):
+        if not header_written:
+            yield f"{segment['source_language']}\t{segment['target_language']}\n"
+            header_written = True
+        yield f"{segment['source']}\t{segment['target']}\n"
+
+class HTMLTextExtractor(HTMLParser):
+
+    # Tags whose content is never displayed
+    SKIPPED_TAGS = {"script", "style", "noscript", "template", "head"}
+
+    # Tags that start a new line of text
+    BLOCK_TAGS = {
+        "address", "article", "aside", "blockquote", "br", "dd", "div", "dl", "dt", "figcaption", "footer",
+        "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main", "nav", "ol", "p", "pre", "section",
+        "table", "td", "th", "title", "tr", "ul",
+    }
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.skip_depth = 0
+        self.parts = []
+        self.lines = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.flush()
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.flush()
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+    def flush(self):
+        text = " ".join("".join(self.parts).split())
+        self.parts = []
+        if text:
+            self.lines.append(text + "\n")
+
+def iter_html_lines(path, part, options):
+    parser = HTMLTextExtractor()
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        # Feed the parser in chunks and hand out the lines completed so far
+        for chunk in iter(lambda: f.read(64 * 1024), ""):
+            parser.feed(chunk)
+            lines, parser.lines = parser.lines, []
+            yield from lines
+    parser.close()
+    parser.flush()
+    yield from parser.lines
+
+def iter_pdf_lines(path, part, options):
+    # Yield the text of each page as soon as it is extracted
+    reader = PdfReader(path)
+    for page in reader.pages:
+        text = page.extract_text(extraction_mode=options.get("pdf_mode", "plain")).strip()
+        if text:
+            yield text + "\n\n"
+
+# A converter lists the parts of a file (e.g. the sheets of a workbook, or a single None part)
+# and streams the upload-ready text of each part. Files of formats the vector store accepts
+# are uploaded as is when no text can be extracted from them.
+Converter = namedtuple("Converter", ["parts", "lines", "upload_raw_if_empty"])
+
+CONVERTERS = {
+    ".xlsx": Converter(list_excel_sheets, iter_excel_lines, False),
+    ".xls": Converter(list_excel_sheets, iter_excel_lines, False),
+    ".csv": Converter(single_part, iter_csv_lines, False),
+    ".docx": Converter(single_part, iter_docx_lines, True),
+    ".tmx": Converter(single_part, iter_tmx_lines, False),
+    ".xliff": Converter(single_part, iter_xliff_lines, False),
+    ".xlf": Converter(single_part, iter_xliff_lines, False),
+    ".html": Converter(single_part, iter_html_lines, True),
+    ".htm": Converter(single_part, iter_html_lines, True),
+    ".pdf": Converter(single_part, iter_pdf_lines, True),
+}
+
+def iter_segments(path):
+    # Segments to post-edit, each with an id, a source text and optionally its machine translation
+    suffix = path.suffix.lower()
+    if suffix in (".xliff", ".xlf"):
+        yield from iter_xliff_segments(path)
+        return
+
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if suffix == ".jsonl":
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                yield {
+                    "id": str(record.get("id", number)),
+                    "source": record.get("source") or record.get("text") or "",
+                    "target": record.get("target") or record.get("mt") or "",
+                    "source_language": record.get("source_language", ""),
+                    "target_language": record.get("target_language", ""),
+                }
+            return
+
+        # TSV columns are named by a header row, or are the source, the source and its machine
+        # translation, or an id, the source and its machine translation
+        rows = csv.reader(f, delimiter="\t")
+        first = next(rows, None) or []
+        header = [cell.strip().lower() for cell in first]
+        if "source" in header:
+            names = {"id": "id", "source": "source", "target": "target" if "target" in header else "mt"}
+            columns = {field: header.index(name) for field, name in names.items() if name in header}
+        else:
+            columns = {1: {"source": 0}, 2: {"source": 0, "target": 1}}.get(len(first), {"id": 0, "source": 1, "target": 2})
+            rows = chain([first], rows)
+        for number, row in enumerate(rows, 1):
+            values = {field: row[column].strip() if column < len(row) else "" for field, column in columns.items()}
+            if values.get("source"):
+                yield {
+                    "id": values.get("id") or str(number),
+                    "source": values["source"],
+                    "target": values.get("target", ""),
+                    "source_language": "",
+                    "target_language": "",
+                }
+
+def convert_part(suffix, path, part, txt_path, options):
+    # Runs in a worker process, so the converter is looked up by suffix rather than passed
+    characters = 0
+    with open(txt_path, "w", encoding="utf-8", newline="") as f:
+        for text in CONVERTERS[suffix].lines(path, part, options):
+            f.write(text)
+            characters += len(text.strip())
+    return characters
+
+def conversion_context():
+    # Start conversion processes without forking a multi-threaded parent, where the platform allows it
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+def scan_directory(directory):
+    # List the files and subdirectories of a single directory, without following symlinks
+    files = []
+    subdirectories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry.path)
+    except OSError as e:
+        print(f"Error scanning directory {directory}: {e}")
+    return files, subdirectories
+
+def scan_files(root, include=None, exclude=None, workers=1, skip=()):
+    # Yield the files under root whose path relative to root matches one of the include
+    # patterns (all files if there are none) and none of the exclude patterns. Excluded
+    # directories are not traversed. Subtrees are scanned in parallel by the workers.
+    root = Path(root)
+    include = include or []
+    exclude = exclude or []
+    skip = {Path(path) for path in skip}
+
+    def relative(path):
+        return Path(path).relative_to(root).as_posix()
+
+    def excluded(path):
+        return Path(path) in skip or any(fnmatch.fnmatch(relative(path), pattern) for pattern in exclude)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # Subdirectories are scanned ahead by the workers, but files are yielded in sorted path
+        # order: the entries of each directory by name, descending into subdirectories in turn
+        stack = [(None, executor.submit(scan_directory, root))]
+        while stack:
+            path, scanned = stack.pop()
+            if scanned is None:
+                if include and not any(fnmatch.fnmatch(relative(path), pattern) for pattern in include):
+                    continue
+                yield Path(path)
+                continue
+
+            files, subdirectories = scanned.result()
+            entries = [(path, None) for path in files if not excluded(path)]
+            entries += [(subdirectory, executor.submit(scan_directory, subdirectory)) for subdirectory in subdirectories if not excluded(subdirectory)]
+            stack.extend(sorted(entries, key=lambda entry: os.path.basename(entry[0]), reverse=True))
+
+def hash_file(path, chunk_size=1024 * 1024):
+    # Compute the SHA-256 of a file without loading it all in memory
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def with_retries(fn, *args, attempts=3, backoff=1.0, **kwargs):
+    # Call fn, retrying with exponential backoff when it raises
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            delay = backoff * 2 ** (attempt - 1)
+            print(f"Attempt {attempt} of {attempts} failed ({e}), retrying in {delay:.0f}s...")
+            time.sleep(delay)
+
+def minhash_signature(path, shingle_size=5, block_size=4096):
+    # Hash the word shingles of the normalized text, reading it line by line
+    shingles = set()
+    window = deque(maxlen=shingle_size)
+    with path.open("r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            for word in line.lower().split():
+                window.append(word)
+                if len(window) == shingle_size:
+                    shingles.add(zlib.crc32(" ".join(window).encode("utf-8")))
+    if not shingles and window:
+        shingles.add(zlib.crc32(" ".join(window).encode("utf-8")))
+    if not shingles:
+        return None
+
+    # Keep the minimum of each permutation, a block of shingles at a time to bound memory
+    hashes = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+    signature = np.full(MINHASH_PERMUTATIONS, MERSENNE_PRIME, dtype=np.uint64)
+    for start in range(0, len(hashes), block_size):
+        block = hashes[start:start + block_size]
+        permuted = (np.outer(MINHASH_A, block) + MINHASH_B[:, None]) % MERSENNE_PRIME
+        signature = np.minimum(signature, permuted.min(axis=1))
+    return signature
+
+async def async_with_retries(fn, *args, attempts=3, backoff=1.0, **kwargs):
+    # Await fn, retrying with exponential backoff when it raises
+    for attempt in range(1, attempts + 1):
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            delay = backoff * 2 ** (attempt - 1)
+            print(f"Attempt {attempt} of {attempts} failed ({e}), retrying in {delay:.0f}s...")
+            await asyncio.sleep(delay)
+
+class ConversionCache:
+
+    def __init__(self, root: Path, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+
+        # Entries used during this run are never evicted, nor the links made to them for each source
+        self.in_use = set()
+        self.linked = set()
+
+    def entry_dir(self, namespace, sha256):
+        return self.root / namespace / sha256
+
+    def lookup(self, namespace, sha256):
+        # An entry is complete once its index has been written
+        entry_dir = self.entry_dir(namespace, sha256)
+        index_path = entry_dir / "index.json"
+        try:
+            with index_path.open("r", encoding="utf-8") as f:
+                index = json.load(f)
+
+            # Entries of earlier versions named their outputs after the source they were converted from
+            if index.get("version") != 2:
+                return None
+            outputs = index["outputs"]
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Error reading cache entry {entry_dir}, converting again: {e}")
+            return None
+
+        # Touch the index so eviction sees the entry as recently used
+        os.utime(index_path)
+        self.in_use.add(entry_dir)
+        return [entry_dir / name for name in outputs]
+
+    def staging_dir(self, namespace, sha256):
+        # Outputs are written in a private directory and only moved in place once complete,
+        # identical files converted at the same time each get their own
+        (self.root / namespace).mkdir(parents=True, exist_ok=True)
+        return Path(tempfile.mkdtemp(prefix=f"{sha256}.", suffix=".tmp", dir=self.root / namespace))
+
+    def commit(self, namespace, sha256, staging, outputs):
+        # An identical file converted earlier in this run already filled the entry, and its outputs may be in use
+        entry_dir = self.entry_dir(namespace, sha256)
+        if entry_dir in self.in_use and (entry_dir / "index.json").exists():
+            shutil.rmtree(staging, ignore_errors=True)
+            return self.lookup(namespace, sha256)
+
+        with (staging / "index.json").open("w", encoding="utf-8") as f:
+            json.dump({"version": 2, "outputs": outputs}, f)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        staging.replace(entry_dir)
+        self.in_use.add(entry_dir)
+        return [entry_dir / name for name in outputs]
+
+    def link(self, txt_path, key, name):
+        # Identical sources share one entry, so each source gets its own link to it, named after the source
+        source_dir = self.root / "sources" / hashlib.sha256(key.encode("utf-8")).hexdigest()
+        source_dir.mkdir(parents=True, exist_ok=True)
+        self.linked.add(source_dir)
+        link_path = source_dir / name
+        link_path.unlink(missing_ok=True)
+        try:
+            os.link(txt_path, link_path)
+        except OSError:
+            shutil.copyfile(txt_path, link_path)
+        return link_path
+
+    def evict(self):
+        # Links of sources not seen in this run are removed
+        for source_dir in (self.root / "sources").glob("*"):
+            if source_dir not in self.linked:
+                shutil.rmtree(source_dir, ignore_errors=True)
+
+        # Staging directories left by interrupted runs are never committed, recent ones may belong to another run
+        for staging in self.root.glob("*/*.tmp"):
+            if staging.stat().st_mtime < time.time() - 86400:
+                shutil.rmtree(staging, ignore_errors=True)
+
+        # Measure every entry and remember when it was last used
+        entries = []
+        for index_path in self.root.glob("*/*/index.json"):
+            entry_dir = index_path.parent
+            size = sum(path.stat().st_size for path in entry_dir.iterdir())
+            entries.append((index_path.stat().st_mtime, size, entry_dir))
+
+        # Drop the least recently used entries until the cache fits its budget
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            if entry_dir in self.in_use:
+                continue
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            print(f"Evicted cached conversion {entry_dir}")
+
+def iter_text_chunks(path, chunk_chars=1500, overlap_chars=200):
+    # Group whole lines into chunks of about chunk_chars characters, repeating the last lines of
+    # each chunk at the start of the next one so segments are not cut from their context
+    lines = deque()
+    size = 0
+    with path.open("r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+
+            # Lines longer than a chunk are split on their own
+            for start in range(0, len(line), chunk_chars):
+                piece = line[start:start + chunk_chars]
+                if lines and size + len(piece) > chunk_chars:
+                    yield "\n".join(lines)
+                    while lines and size > overlap_chars:
+                        size -= len(lines.popleft()) + 1
+                lines.append(piece)
+                size += len(piece) + 1
+    if lines:
+        yield "\n".join(lines)
+
+def top_rows(rows, scores, top_k):
+    # The top_k rows by decreasing score
+    if len(scores) > top_k:
+        keep = np.argpartition(-scores, top_k - 1)[:top_k]
+        rows, scores = rows[keep], scores[keep]
+    order = np.argsort(-scores)
+    return rows[order], scores[order]
+
+def nearest_centroids(data, centroids, block_rows=8192):
+    # Index of the closest centroid of each row, the squared norm of the rows does not change the order
+    norms = (centroids ** 2).sum(axis=1)
+    labels = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), block_rows):
+        block = data[start:start + block_rows]
+        labels[start:start + len(block)] = np.argmin(norms - 2 * block @ centroids.T, axis=1)
+    return labels
+
+def kmeans(data, k, iterations=10):
+    # Lloyd's algorithm started from distinct random rows
+    k = min(k, len(data))
+    centroids = data[np.random.default_rng(0).choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = nearest_centroids(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, data)
+        counts = np.bincount(labels, minlength=k)
+        centroids[counts > 0] = sums[counts > 0] / counts[counts > 0, None]
+    return centroids
+
+def fold_text(text):
+    # Lowercase and turn whitespace into spaces without changing the length, so positions
+    # in the folded text are positions in the original one
+    return "".join(" " if c.isspace() else c.lower() if len(c.lower()) == 1 else c for c in text)
+
+def fold_with_offsets(text):
+    # Folded text with every whitespace run collapsed into one space, and the position in
+    # text of each of its characters
+    folded = fold_text(text)
+    kept = [i for i, c in enumerate(folded) if c != " " or (i and folded[i - 1] != " ")]
+    return "".join(folded[i] for i in kept), kept
+
+def iter_tm_records(txt_path):
+    # Converted TMX and XLIFF files start with a line of languages, the first one being the source
+    with open(txt_path, "r", encoding="utf-8") as f:
+        languages = [language.lower() for language in f.readline().rstrip("\n").split("\t")]
+        for line in f:
+            cells = line.rstrip("\n").split("\t")
+            if not cells[0]:
+                continue
+            for language, target in zip(languages[1:], cells[1:]):
+                if target:
+                    yield {"source": cells[0], "target": target, "source_language": languages[0], "target_language": language}
+
+def char_ngrams(text, n=3):
+    # Padded so that texts shorter than n still have one n-gram
+    text = f" {text} "
+    return {text[i:i + n] for i in range(max(1, len(text) - n + 1))}
+
+def match_tokens(text):
+    return re.findall(r"\w+|[^\w\s]", text.lower())
+
+def levenshtein(a, b):
+    # Edit distance between two sequences, one row of the table at a time
+    previous = list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        current = [i]
+        for j, y in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (x != y)))
+        previous = current
+    return previous[-1]
+
+def normalize_language(language):
+    return (language or "").strip().lower().replace("_", "-")
+
+def language_matches(language, wanted):
+    # A language matches itself, its regional variants and the base language of a variant,
+    # an unknown language only matches another unknown one
+    language, wanted = normalize_language(language), normalize_language(wanted)
+    if not language or not wanted:
+        return language == wanted
+    return language == wanted or language.startswith(wanted + "-") or wanted.startswith(language + "-")
+
+def completed_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+def failed_future(error):
+    future = Future()
+    future.set_exception(error)
+    return future
+
+def forward_future(source, target):
+    # Settle target with the outcome of source
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+def estimate_tokens(text):
+    # About four characters per token, close enough to size packs without a tokenizer
+    return len(text) // 4 + 1
+
+def parse_pack_response(text):
+    # The answer should be a JSON object of post-edits by segment id, possibly in a code fence
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[-1].rsplit("```", 1)[0]
+    answer = json.loads(text)
+    if not isinstance(answer, dict):
+        raise ValueError("the answer is not a JSON object")
+    return {str(key): value.strip() for key, value in answer.items() if isinstance(value, str) and value.strip()}
+
+def read_glossary_sheet(txt_path):
+    # The first language column holds the source terms, the others their translations
+    with open(txt_path, "r", encoding="utf-8", newline="") as f:
+        rows = csv.reader(f, delimiter="\t")
+        header = next(rows, None) or []
+        columns = [(i, h.strip().lower().replace("_", "-")) for i, h in enumerate(header) if LANGUAGE_HEADER.match(h.strip()) and h.strip().lower() not in NON_LANGUAGE_HEADERS]
+        if len(columns) < 2:
+            return None
+        (source_column, source_language), target_columns = columns[0], columns[1:]
+        terms = []
+        for row in rows:
+            source = row[source_column].strip() if source_column < len(row) else ""
+            translations = {language: row[i].strip() for i, language in target_columns if i < len(row) and row[i].strip()}
+            if source and translations:
+                terms.append([source, translations])
+    return {"source_language": source_language, "terms": terms}
+
+class GlossaryIndex:
+
+    # Aho-Corasick automaton over the folded source terms of every glossary sheet, finding all
+    # the terms of a segment in a single pass over it
+    def __init__(self, sheets):
+        self.terms = []
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        for key, sheet in sheets.items():
+            for source, translations in sheet["terms"]:
+                term = " ".join(fold_text(source).split())
+                if term:
+                    self.insert(term, len(self.terms))
+                    self.terms.append({"source": source, "length": len(term), "translations": translations, "file": key})
+        self.build_failure_links()
+
+    @classmethod
+    def load(cls, path: Path):
+        if not path.exists():
+            raise ValueError(f"No glossary in {path}, convert glossary spreadsheets first.")
+        with path.open("r", encoding="utf-8") as f:
+            return cls(json.load(f)["sheets"])
+
+    def insert(self, term, term_id):
+        state = 0
+        for c in term:
+            next_state = self.goto[state].get(c)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][c] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            state = next_state
+        self.outputs[state].append(term_id)
+
+    def build_failure_links(self):
+        # Breadth first, so the failure state of every shallower state is already known
+        pending = deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for c, next_state in self.goto[state].items():
+                pending.append(next_state)
+                fail = self.fail[state]
+                while fail and c not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(c, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+    def find(self, text, target_language=None):
+        # Every whole-word occurrence of a source term, with its translations into target_language
+        # (or a regional variant of it), or into every language when it is not given
+        folded, offsets = fold_with_offsets(text)
+        target_language = normalize_language(target_language)
+        hits = []
+        state = 0
+        for end, c in enumerate(folded, 1):
+            while state and c not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(c, 0)
+            for term_id in self.outputs[state]:
+                term = self.terms[term_id]
+                start = end - term["length"]
+                if (start > 0 and folded[start - 1].isalnum()) or (end < len(folded) and folded[end].isalnum()):
+                    continue
+                translations = {
+                    language: target for language, target in term["translations"].items()
+                    if not target_language or normalize_language(language) == target_language or normalize_language(language).startswith(target_language + "-")
+                }
+                if translations:
+                    # Back to positions in the original text, whitespace runs included
+                    first, last = offsets[start], offsets[end - 1] + 1
+                    hits.append({"start": first, "end": last, "text": text[first:last], "source": term["source"], "translations": translations, "file": term["file"]})
+        return sorted(hits, key=lambda hit: (hit["start"], -hit["end"]))
+
+    def prompt(self, text, target_language=None):
+        # Glossary entries to inject into a prompt, once each, in the order they appear in the text
+        lines = []
+        for hit in self.find(text, target_language):
+            for language, target in hit["translations"].items():
+                line = f"- {hit['source']} -> {target} ({language})"
+                if line not in lines:
+                    lines.append(line)
+        return "\n".join(lines)
+
+class FuzzyMatcher:
+
+    # Character trigram index over the translation memory sources to find candidates quickly,
+    # which are then scored by word-level edit distance
+    def __init__(self, records, n=3):
+        self.records = records
+        self.n = n
+        self.exact = {}
+        self.target_languages = {normalize_language(record["target_language"]) for record in records}
+        postings = {}
+        for i, record in enumerate(records):
+            self.exact.setdefault(normalize_segment(record["source"]), []).append(i)
+            for gram in char_ngrams(" ".join(fold_text(record["source"]).split()), n):
+                postings.setdefault(gram, []).append(i)
+        self.postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()}
+
+    @classmethod
+    def load(cls, path: Path):
+        with path.open("r", encoding="utf-8") as f:
+            return cls([json.loads(line) for line in f if line.strip()])
+
+    def languages_match(self, record, target_language, source_language):
+        # The source language is checked when the segment states it
+        if source_language and not language_matches(record["source_language"], source_language):
+            return False
+        return language_matches(record["target_language"], target_language)
+
+    def match(self, text, threshold, target_language=None, source_language=None, candidates=50):
+        # Without a target language, a match is only safe when the memories have a single one
+        if not normalize_language(target_language):
+            if len(self.target_languages) != 1:
+                return None
+            target_language = next(iter(self.target_languages))
+
+        # A 100% match has the same text, up to whitespace
+        for i in self.exact.get(normalize_segment(text), []):
+            if self.languages_match(self.records[i], target_language, source_language):
+                return self.records[i], 1.0
+        if threshold >= 1:
+            return None
+
+        # Candidates are the sources sharing the most n-grams with the text
+        postings = [self.postings[gram] for gram in char_ngrams(" ".join(fold_text(text).split()), self.n) if gram in self.postings]
+        if not postings:
+            return None
+        ids, counts = np.unique(np.concatenate(postings), return_counts=True)
+        query = match_tokens(text)
+        best, best_score = None, threshold
+        for i in ids[np.argsort(-counts, kind="stable")[:candidates]]:
+            record = self.records[i]
+            if not self.languages_match(record, target_language, source_language):
+                continue
+
+            # Skip the edit distance when the length difference alone rules the candidate out,
+            # with some slack so candidates scoring exactly the threshold are not lost to rounding
+            tokens = match_tokens(record["source"])
+            longest = max(len(query), len(tokens), 1)
+            if abs(len(query) - len(tokens)) > (1 - best_score) * longest + 1e-9:
+                continue
+
+            # Texts differing only in case or punctuation spacing are close, but not a 100% match
+            score = min(1 - levenshtein(query, tokens) / longest, 0.99)
+            if score >= best_score:
+                best, best_score = record, score
+        return (best, best_score) if best is not None else None
+
+class HashingEmbedder:
+
+    # Deterministic bag-of-words embedding, for offline runs and tests
+    def __init__(self, dimensions=512):
+        self.dimensions = dimensions
+        self.name = f"hashing-{dimensions}"
+
+    def embed(self, texts):
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in re.findall(r"\w+", text.lower()):
+                # The top bit of the hash gives a sign so colliding tokens tend to cancel out
+                h = zlib.crc32(token.encode("utf-8"))
+                matrix[row, h % self.dimensions] += -1.0 if h >> 31 else 1.0
+        return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+class OpenAIEmbedder:
+
+    def __init__(self, client, model="text-embedding-3-small"):
+        self.client = client
+        self.model = model
+        self.name = model
+
+    def embed(self, texts):
+        response = with_retries(self.client.embeddings.create, model=self.model, input=list(texts))
+        matrix = np.array([item.embedding for item in response.data], dtype=np.float32)
+        return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+# Embedders by name, each built from the OpenAI client (unused offline)
+EMBEDDERS = {
+    "hashing": lambda client: HashingEmbedder(),
+    "openai": lambda client: OpenAIEmbedder(client),
+}
+
+class LocalIndex:
+
+    def __init__(self, root: Path, dtype="float16"):
+        self.root = root
+        self.dtype = dtype
+
+        # Raw embedding matrix and byte offsets of each chunk in the JSONL table, both appended
+        # in place; index.json holds the committed row count, so readers never see partial rows
+        self.embeddings_path = root / "embeddings.bin"
+        self.offsets_path = root / "offsets.bin"
+        self.chunks_path = root / "chunks.jsonl"
+        self.info_path = root / "index.json"
+
+    def load_info(self):
+        if not self.info_path.exists():
+            return None
+        with self.info_path.open("r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_info(self, info):
+        tmp_path = self.info_path.with_name(self.info_path.name + ".tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump(info, f)
+        tmp_path.replace(self.info_path)
+
+    def open_for_append(self, embedder):
+        # Start a new index when there is none or it was built with another embedder or precision
+        info = self.load_info()
+        if info and (info["embedder"] != embedder.name or info["dtype"] != self.dtype):
+            print(f"Index {self.root} was built with '{info['embedder']}' in {info['dtype']}, rebuilding it.")
+            info = None
+        if info is None:
+            shutil.rmtree(self.root, ignore_errors=True)
+            self.root.mkdir(parents=True)
+            for path in (self.embeddings_path, self.offsets_path, self.chunks_path):
+                path.touch()
+            info = {"embedder": embedder.name, "dtype": self.dtype, "dimensions": 0, "count": 0, "chunks_bytes": 0, "documents": {}}
+            self.save_info(info)
+        return info
+
+    def is_indexed(self, info, key, sha256):
+        document = info["documents"].get(key)
+        return bool(document and document["sha256"] == sha256)
+
+    def append(self, info, documents, embedder, batch_size=256):
+        # Documents are (key, sha256, chunks) tuples, a new version of a document replaces the
+        # previous one, whose rows stay in the files until the index is compacted
+        itemsize = np.dtype(self.dtype).itemsize
+        with self.embeddings_path.open("r+b") as embeddings, self.offsets_path.open("r+b") as offsets, self.chunks_path.open("r+b") as chunks:
+            # Drop whatever an interrupted append wrote after the last commit
+            embeddings.truncate(info["count"] * info["dimensions"] * itemsize)
+            offsets.truncate(info["count"] * 8)
+            chunks.truncate(info["chunks_bytes"])
+            for f in (embeddings, offsets, chunks):
+                f.seek(0, os.SEEK_END)
+
+            pending = []
+            finished = []
+
+            def flush():
+                matrix = embedder.embed([chunk["text"] for chunk in pending]).astype(self.dtype)
+                info["dimensions"] = info["dimensions"] or matrix.shape[1]
+                embeddings.write(matrix.tobytes())
+                for chunk in pending:
+                    offsets.write(np.array([chunks.tell()], dtype=np.uint64).tobytes())
+                    chunks.write((json.dumps(chunk, ensure_ascii=False) + "\n").encode("utf-8"))
+                for f in (embeddings, offsets, chunks):
+                    f.flush()
+                info["count"] += len(pending)
+                info["chunks_bytes"] = chunks.tell()
+                pending.clear()
+
+                # Commit the documents whose rows are all written
+                while finished and finished[0][3] <= info["count"]:
+                    key, sha256, start, stop = finished.pop(0)
+                    info["documents"][key] = {"sha256": sha256, "start": start, "stop": stop}
+                self.save_info(info)
+
+            for key, sha256, document_chunks in documents:
+                start = info["count"] + len(pending)
+                for chunk in document_chunks:
+                    pending.append(chunk)
+                    if len(pending) >= batch_size:
+                        flush()
+                finished.append((key, sha256, start, info["count"] + len(pending)))
+            if pending or finished:
+                flush()
+
+    def forget(self, info, keys):
+        for key in keys:
+            info["documents"].pop(key, None)
+        self.save_info(info)
+
+    def live_rows(self, info):
+        live = np.zeros(info["count"], dtype=bool)
+        for document in info["documents"].values():
+            live[document["start"]:document["stop"]] = True
+        return live
+
+    def open_matrix(self, info, mode="r"):
+        return np.memmap(self.embeddings_path, dtype=info["dtype"], mode=mode, shape=(info["count"], info["dimensions"]))
+
+    def compact(self, info, block_rows=65536):
+        # Copy the live rows into a new index and swap it in once complete
+        live = self.live_rows(info)
+        staging = self.root.with_name(f"{self.root.name}.{os.getpid()}.tmp")
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        compacted = LocalIndex(staging, info["dtype"])
+        new_info = dict(info, count=0, chunks_bytes=0, documents={})
+        matrix = self.open_matrix(info)
+        offsets = np.fromfile(self.offsets_path, dtype=np.uint64, count=info["count"])
+        with compacted.embeddings_path.open("wb") as embeddings, compacted.offsets_path.open("wb") as new_offsets, \
+                compacted.chunks_path.open("wb") as chunks, self.chunks_path.open("rb") as old_chunks:
+            for key, document in sorted(info["documents"].items(), key=lambda item: item[1]["start"]):
+                start = new_info["count"]
+                for row in range(document["start"], document["stop"], block_rows):
+                    stop = min(row + block_rows, document["stop"])
+                    embeddings.write(np.ascontiguousarray(matrix[row:stop]).tobytes())
+                    for offset in offsets[row:stop]:
+                        old_chunks.seek(int(offset))
+                        new_offsets.write(np.array([chunks.tell()], dtype=np.uint64).tobytes())
+                        chunks.write(old_chunks.readline())
+                new_info["count"] += document["stop"] - document["start"]
+                new_info["documents"][key] = dict(document, start=start, stop=new_info["count"])
+            new_info["chunks_bytes"] = chunks.tell()
+        compacted.save_info(new_info)
+        del matrix
+        print(f"Compacted index {self.root} from {info['count']} to {new_info['count']} rows ({int(live.sum())} live).")
+
+        # Readers that already mapped the old files keep reading them until they reopen the index
+        old = self.root.with_name(f"{self.root.name}.{os.getpid()}.old")
+        self.root.replace(old)
+        staging.replace(self.root)
+        shutil.rmtree(old, ignore_errors=True)
+        return new_info
+
+    def search(self, query, embedder, top_k=5, ann=None):
+        info = self.load_info()
+        if info is None:
+            raise ValueError(f"No local index in {self.root}, build it with --local first.")
+        if info["embedder"] != embedder.name:
+            raise ValueError(f"Index {self.root} was built with embedder '{info['embedder']}', not '{embedder.name}'.")
+        if not info["count"]:
+            return []
+        vector = embedder.embed([query])[0].astype(np.float32)
+        rows, scores = (ann or self).nearest(info, vector, top_k)
+        return self.read_chunks(info, rows, scores)
+
+    def nearest(self, info, vector, top_k, block_rows=65536):
+        # Scan the mapped matrix a block at a time, so only the pages being scored are in memory,
+        # and keep the best rows seen so far; embeddings are normalized, so the dot product is the cosine
+        matrix = self.open_matrix(info)
+        live = self.live_rows(info)
+        best_rows = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype=np.float32)
+        for start in range(0, info["count"], block_rows):
+            scores = np.asarray(matrix[start:start + block_rows], dtype=np.float32) @ vector
+            scores[~live[start:start + block_rows]] = -np.inf
+            rows = np.concatenate([best_rows, np.arange(start, start + len(scores))])
+            scores = np.concatenate([best_scores, scores])
+            best_rows, best_scores = top_rows(rows, scores, top_k)
+        return best_rows, best_scores
+
+    def read_chunks(self, info, rows, scores):
+        # Read back the text of the best chunks only, through the offsets table
+        offsets = np.memmap(self.offsets_path, dtype=np.uint64, mode="r", shape=(info["count"],))
+        hits = []
+        with self.chunks_path.open("rb") as f:
+            for row, score in zip(rows, scores):
+                if score == -np.inf:
+                    break
+                f.seek(int(offsets[row]))
+                hits.append(dict(json.loads(f.readline()), score=float(score)))
+        return hits
+
+class IVFPQIndex:
+
+    # Inverted file over k-means lists of the local index rows, with the residual of each row to
+    # its list centroid product-quantized to one byte per subspace; the best approximate matches
+    # are re-scored exactly from the mapped matrix
+    def __init__(self, index: LocalIndex, lists=None, subspaces=16, probes=8, rerank=100):
+        self.index = index
+        self.lists = lists
+        self.subspaces = subspaces
+        self.probes = probes
+        self.rerank = rerank
+        self.info_path = index.root / "ivf.json"
+        self.centroids_path = index.root / "ivf_centroids.npy"
+        self.codebooks_path = index.root / "ivf_codebooks.npy"
+
+    def lists_paths(self, ann_info):
+        # Row ids and codes of the rows sorted by list, written anew under the next generation at each
+        # update; ivf.json holds the offset of each list in them and names the current generation
+        return (self.index.root / f"ivf_rows.{ann_info['generation']}.bin",
+                self.index.root / f"ivf_codes.{ann_info['generation']}.bin")
+
+    def open_lists(self, ann_info):
+        count = ann_info["list_offsets"][-1]
+        if not count:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, ann_info["subspaces"]), dtype=np.uint8)
+        rows_path, codes_path = self.lists_paths(ann_info)
+        return (np.memmap(rows_path, dtype=np.int64, mode="r", shape=(count,)),
+                np.memmap(codes_path, dtype=np.uint8, mode="r", shape=(count, ann_info["subspaces"])))
+
+    def load_info(self):
+        if not self.info_path.exists():
+            return None
+        with self.info_path.open("r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_info(self, ann_info):
+        tmp_path = self.info_path.with_name(self.info_path.name + ".tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump(ann_info, f)
+        tmp_path.replace(self.info_path)
+
+    def update(self, info, sample_size=20000):
+        # Train again when there is no model yet, the index was rebuilt or compacted (which removes
+        # the model files), or it grew four times since training; otherwise only encode the new rows
+        ann_info = self.load_info()
+        if ann_info is None or "list_offsets" not in ann_info or ann_info["encoded_count"] > info["count"] or info["count"] > 4 * ann_info["trained_count"]:
+            ann_info = self.train(info, sample_size)
+        if ann_info is not None:
+            self.encode(info, ann_info)
+
+    def train(self, info, sample_size):
+        live = np.flatnonzero(self.index.live_rows(info))
+        if not len(live):
+            return None
+
+        # Train on a sample of the live rows, read in row order from the mapped matrix
+        sample_rows = np.sort(np.random.default_rng(0).choice(live, min(sample_size, len(live)), replace=False))
+        sample = np.asarray(self.index.open_matrix(info)[sample_rows], dtype=np.float32)
+        centroids = kmeans(sample, self.lists or int(np.sqrt(len(live))) or 1)
+        residuals = sample - centroids[nearest_centroids(sample, centroids)]
+
+        # Subspaces must split the dimensions evenly
+        subspaces = max(s for s in range(1, min(self.subspaces, info["dimensions"]) + 1) if info["dimensions"] % s == 0)
+        codebooks = np.stack([kmeans(part, 256) for part in np.split(residuals, subspaces, axis=1)])
+
+        np.save(self.centroids_path, centroids)
+        np.save(self.codebooks_path, codebooks)
+        for path in self.index.root.glob("ivf_*.bin"):
+            path.unlink()
+        ann_info = {"lists": len(centroids), "subspaces": subspaces, "trained_count": info["count"], "encoded_count": 0,
+                    "generation": 0, "list_offsets": [0] * (len(centroids) + 1)}
+        self.save_info(ann_info)
+        print(f"Trained {len(centroids)} lists and {subspaces} subspace codebooks on {len(sample)} rows.")
+        return ann_info
+
+    def encode(self, info, ann_info, block_rows=65536):
+        # Assign and encode the rows appended since the last update
+        centroids = np.load(self.centroids_path)
+        codebooks = np.load(self.codebooks_path)
+        matrix = self.index.open_matrix(info)
+        old_rows, old_codes = self.open_lists(ann_info)
+        labels = [np.repeat(np.arange(ann_info["lists"]), np.diff(ann_info["list_offsets"]))]
+        rows = [np.asarray(old_rows)]
+        codes = [np.asarray(old_codes)]
+        for start in range(ann_info["encoded_count"], info["count"], block_rows):
+            block = np.asarray(matrix[start:start + block_rows], dtype=np.float32)
+            block_labels = nearest_centroids(block, centroids)
+            parts = np.split(block - centroids[block_labels], ann_info["subspaces"], axis=1)
+            codes.append(np.stack([nearest_centroids(part, codebook) for part, codebook in zip(parts, codebooks)], axis=1).astype(np.uint8))
+            labels.append(block_labels)
+            rows.append(np.arange(start, start + len(block), dtype=np.int64))
+
+        # Merge them into the lists, keeping the rows of each list in row order
+        labels = np.concatenate(labels)
+        order = np.argsort(labels, kind="stable")
+        previous_paths = self.lists_paths(ann_info)
+        ann_info["generation"] += 1
+        rows_path, codes_path = self.lists_paths(ann_info)
+        np.concatenate(rows)[order].tofile(rows_path)
+        np.concatenate(codes)[order].tofile(codes_path)
+        ann_info["list_offsets"] = [0] + np.cumsum(np.bincount(labels, minlength=ann_info["lists"])).tolist()
+        ann_info["encoded_count"] = info["count"]
+        self.save_info(ann_info)
+
+        # Readers that already mapped the previous generation keep reading it until they reopen the index
+        for path in previous_paths:
+            path.unlink(missing_ok=True)
+
+    def nearest(self, info, vector, top_k):
+        ann_info = self.load_info()
+        if ann_info is None:
+            raise ValueError(f"No approximate index in {self.index.root}, build it with --local --ann first.")
+        centroids = np.load(self.centroids_path)
+        codebooks = np.load(self.codebooks_path)
+        encoded = ann_info["encoded_count"]
+        live = self.index.live_rows(info)
+
+        # Probe the lists whose centroids are closest to the query, reading only their own rows and codes
+        centroid_scores = centroids @ vector
+        probed = np.argsort(-centroid_scores)[:self.probes]
+        list_rows, list_codes = self.open_lists(ann_info)
+        list_offsets = ann_info["list_offsets"]
+        spans = [(list_offsets[l], list_offsets[l + 1]) for l in probed]
+        rows = np.concatenate([list_rows[start:stop] for start, stop in spans])
+        codes = np.concatenate([list_codes[start:stop] for start, stop in spans])
+        base_scores = np.concatenate([np.full(stop - start, centroid_scores[l], dtype=np.float32) for l, (start, stop) in zip(probed, spans)])
+        keep = live[rows]
+        rows, codes, base_scores = rows[keep], codes[keep], base_scores[keep]
+
+        # Approximate scores: the query against the centroid plus the query against the quantized residual
+        table = np.einsum("skd,sd->sk", codebooks, vector.reshape(ann_info["subspaces"], -1))
+        scores = base_scores + table[np.arange(ann_info["subspaces"]), codes].sum(axis=1)
+        candidates, _ = top_rows(rows, scores, max(self.rerank, top_k))
+
+        # Re-score the best candidates exactly, with the rows appended since the last encoding
+        candidates = np.sort(np.concatenate([candidates, np.flatnonzero(live[encoded:]) + encoded]))
+        if not len(candidates):
+            return candidates, np.zeros(0, dtype=np.float32)
+        exact = np.asarray(self.index.open_matrix(info)[candidates], dtype=np.float32) @ vector
+        return top_rows(candidates, exact, top_k)
+
+class MinHashIndex:
+
+    def __init__(self, threshold, bands=MINHASH_BANDS):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = MINHASH_PERMUTATIONS // bands
+        self.buckets = {}
+        self.signatures = {}
+
+    def band_keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def add(self, key, signature):
+        self.signatures[key] = signature
+        for band_key in self.band_keys(signature):
+            self.buckets.setdefault(band_key, []).append(key)
+
+    def find(self, signature):
+        # Only compare with the files sharing at least one band, and return the most similar one
+        candidates = {key for band_key in self.band_keys(signature) for key in self.buckets.get(band_key, [])}
+        best_key, best_similarity = None, self.threshold
+        for key in candidates:
+            similarity = float(np.mean(self.signatures[key] == signature))
+            if similarity >= best_similarity:
+                best_key, best_similarity = key, similarity
+        return best_key
+
+class UploadManifest:
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries = {}
+
+        # Files uploaded by an interrupted run but not yet added to the vector store
+        self.pending = {}
+
+        # MinHash signatures of uploaded text files, for near-duplicate detection
+        self.minhashes = {}
+
+        # Load the previous sync state if there is one
+        if self.path.exists():
+            try:
+                with self.path.open("r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.entries = data.get("files", {})
+                self.pending = data.get("pending", {})
+                self.minhashes = data.get("minhash", {})
+            except Exception as e:
+                print(f"Error reading manifest {self.path}, starting from an empty one: {e}")
+                self.entries = {}
+                self.pending = {}
+                self.minhashes = {}
+
+    def file_hash(self, key, path, stat):
+        # Reuse the stored hash when size and modification time did not change
+        entry = self.entries.get(key)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            return entry["sha256"]
+        return hash_file(path)
+
+    def is_synced(self, key, sha256, vector_store_id):
+        # A file is synced if the same content was already added to this vector store
+        entry = self.entries.get(key)
+        return bool(
+            entry
+            and entry["sha256"] == sha256
+            and entry.get("file_id")
+            and entry.get("vector_store_id") == vector_store_id
+        )
+
+    def keys_by_content(self, vector_store_id):
+        # One file name per content already in this vector store
+        return {
+            entry["sha256"]: key
+            for key, entry in self.entries.items()
+            if entry.get("file_id") and entry.get("vector_store_id") == vector_store_id
+        }
+
+    def referenced_file_ids(self):
+        return {entry["file_id"] for entry in self.entries.values() if entry.get("file_id")}
+
+    def pending_file_id(self, key, sha256, vector_store_id):
+        # Reuse an upload from an interrupted run if it holds the same content for the same store
+        pending = self.pending.get(key)
+        if pending and pending["sha256"] == sha256 and pending["vector_store_id"] == vector_store_id:
+            return pending["file_id"]
+        return None
+
+    def record_pending(self, key, sha256, file_id, vector_store_id):
+        self.pending[key] = {"sha256": sha256, "file_id": file_id, "vector_store_id": vector_store_id}
+
+    def record(self, key, stat, sha256, file_id, vector_store_id):
+        self.entries[key] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sha256": sha256,
+            "file_id": file_id,
+            "vector_store_id": vector_store_id,
+        }
+        self.pending.pop(key, None)
+
+    def save(self):
+        # Write to a temporary file first so an interrupted run never leaves a truncated manifest
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump({"version": 1, "files": self.entries, "pending": self.pending, "minhash": self.minhashes}, f, indent=2, sort_keys=True)
+        tmp_path.replace(self.path)
+
+class BatchProgress:
+
+    def __init__(self):
+        self.done_batches = 0
+        self.done_files = 0
+        self.done_bytes = 0
+        self.started = time.monotonic()
+
+    def update(self, batch):
+        self.done_batches += 1
+        self.done_files += len(batch)
+        self.done_bytes += sum(stat.st_size for _, _, stat, _ in batch)
+
+        # Report progress and throughput since the start of the sync, totals are unknown
+        # while files are still being scanned and converted
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        print(
+            f"Batch {self.done_batches}: "
+            f"{self.done_files} files, {self.done_bytes / 1e6:.1f} MB so far, "
+            f"{self.done_files / elapsed:.1f} files/s, {self.done_bytes / 1e6 / elapsed:.2f} MB/s"
+        )
+
+class SyncState:
+
+    # What a sync has found and done so far, kept across its batches
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.local_keys = set()
+        self.remote_index = None
+        self.uploaded_files = []
+        self.duplicate_files = []
+        self.stale_files = []
+        self.orphan_files = []
+        self.changed_count = 0
+        self.progress = BatchProgress()
+
+class SegmentCache:
+
+    def __init__(self, path: Path, ttl_seconds, max_entries):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.puts = 0
+
+        # One connection shared by the runner threads, writes are committed by put and close
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS segments (key TEXT PRIMARY KEY, post_edit TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS segments_accessed ON segments (accessed)")
+        self.connection.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT post_edit FROM segments WHERE key = ? AND created >= ?", (key, now - self.ttl_seconds)
+            ).fetchone()
+            if row:
+                self.connection.execute("UPDATE segments SET accessed = ? WHERE key = ?", (now, key))
+        return row[0] if row else None
+
+    def put(self, key, post_edit):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?)", (key, post_edit, now, now))
+            self.puts += 1
+            if self.puts % 1000 == 0:
+                self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        # Drop expired results, then the least recently used ones beyond the size limit
+        self.connection.execute("DELETE FROM segments WHERE created < ?", (time.time() - self.ttl_seconds,))
+        self.connection.execute(
+            "DELETE FROM segments WHERE key IN (SELECT key FROM segments ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.max_entries,)
+        )
+
+    def close(self):
+        with self.lock:
+            self.evict()
+            self.connection.commit()
+            self.connection.close()
+
+# What a post-editing run needs to answer each segment
+RunContext = namedtuple(
+    "RunContext",
+    ["assistant_id", "post_edit", "glossary", "cache", "cache_context", "matcher", "tm_threshold", "pack_tokens", "pack_segments", "pack", "stats"],
+)
+
+class RunStats:
+
+    def __init__(self, report_every=100):
+        self.report_every = report_every
+        self.latencies = []
+        self.first_tokens = []
+        self.errors = 0
+        self.cached = 0
+        self.tm_matches = 0
+        self.packs = 0
+        self.unpacked = 0
+        self.started = time.monotonic()
+
+    def update(self, latency=None, first_token=None):
+        # Failed segments have no latency
+        if latency is None:
+            self.errors += 1
+        else:
+            self.latencies.append(latency)
+            self.first_tokens.append(latency if first_token is None else first_token)
+        if (len(self.latencies) + self.errors) % self.report_every == 0:
+            self.report()
+
+    def report(self):
+        # Throughput since the start of the run, latency per segment from request to answer
+        count = len(self.latencies) + self.errors
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        p50, p95 = np.percentile(self.latencies, [50, 95]) if self.latencies else (0, 0)
+        first_token_p50 = np.percentile(self.first_tokens, 50) if self.first_tokens else 0
+        print(
+            f"{len(self.latencies)} of {count} segments post-edited in {elapsed:.1f}s "
+            f"({count / elapsed:.2f} segments/s), latency p50 {p50:.2f}s, p95 {p95:.2f}s, "
+            f"max {max(self.latencies, default=0):.2f}s, first token p50 {first_token_p50:.2f}s, "
+            f"{self.tm_matches} from translation memory, {self.cached} from cache"
+            + (f", {self.packs} packs ({self.unpacked} segments run alone after a bad answer)" if self.packs else "")
+        )
+
+class RemoteFileIndex:
+
+    def __init__(self, remote_files):
+        self.ids_by_name = {}
+
+        # Index every remote file once, the page iterator follows pagination for us
+        for f in remote_files:
+            self.ids_by_name.setdefault(f.filename, []).append(f.id)
+        print(f"Indexed {sum(len(ids) for ids in self.ids_by_name.values())} remote files.")
+
+    def find(self, filename):
+        return list(self.ids_by_name.get(filename, []))
 
 class FilesToAssistant:
     
-    def __init__(self, overwrite: bool):
+    def __init__(
+        self,
+        overwrite: bool,
+        rebuild: bool = False,
+        workers: int = 8,
+        batch_files: int = 100,
+        batch_mb: float = 100,
+        max_open_files: int = 64,
+        convert_workers: int = None,
+        streaming_threshold_mb: float = 20,
+        cache_max_mb: float = 1024,
+        extract_pdf: bool = False,
+        pdf_mode: str = "plain",
+        include: list = None,
+        exclude: list = None,
+        scan_workers: int = 4,
+        queue_size: int = 256,
+        near_duplicate_threshold: float = None,
+        embedder: str = "hashing",
+        index_dtype: str = "float16",
+        ann: bool = False,
+        ann_lists: int = None,
+        ann_probes: int = 8,
+        ann_rerank: int = 100,
+        offline: bool = False,
+    ):
 
         # Load environment variables from .env file
         load_dotenv()
@@ -16,14 +1495,72 @@ class FilesToAssistant:
         # Get variables from environment
         self.OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
         self.OUTPUT_DIR = Path(os.getenv('OUTPUT_DIR', 'Docs'))
+
+        # Sidecar files sit next to the output directory, resolved first so '.' has a name
+        output_dir = self.OUTPUT_DIR.resolve()
+        self.MANIFEST_PATH = Path(os.getenv('MANIFEST_PATH', output_dir.with_name(f"{output_dir.name}.manifest.json")))
+        self.CACHE_DIR = Path(os.getenv('CACHE_DIR', output_dir.with_name(f"{output_dir.name}.cache")))
+        self.SEGMENT_CACHE_PATH = Path(os.getenv('SEGMENT_CACHE_PATH', output_dir.with_name(f"{output_dir.name}.segments.sqlite")))
+        self.TM_PATH = Path(os.getenv('TM_PATH', output_dir.with_name(f"{output_dir.name}.tm.jsonl")))
+        self.GLOSSARY_PATH = Path(os.getenv('GLOSSARY_PATH', output_dir.with_name(f"{output_dir.name}.glossary.json")))
+        self.LOCAL_INDEX_DIR = Path(os.getenv('LOCAL_INDEX_DIR', output_dir.with_name(f"{output_dir.name}.index")))
         self.overwrite = overwrite
+        self.rebuild = rebuild
+        self.workers = max(1, workers)
+        self.batch_files = max(1, batch_files)
+        self.batch_bytes = batch_mb * 1e6
+
+        # Cap the number of local files open at the same time, whatever the number of workers
+        self.max_open_files = max(1, max_open_files)
+        self.open_files = threading.BoundedSemaphore(self.max_open_files)
+
+        # Number of processes used to convert files, one per CPU by default
+        self.convert_workers = max(1, convert_workers or os.cpu_count() or 1)
+
+        # Files at least this large are converted row by row without pandas
+        self.streaming_threshold_bytes = streaming_threshold_mb * 1e6
+
+        # Converted files are cached by content hash and reused as long as the source does not change
+        self.conversion_cache = ConversionCache(self.CACHE_DIR, cache_max_mb * 1e6)
+        self.converted_keys = {}
+
+        # Term pairs read from converted spreadsheets, by converted file
+        self.glossary_sheets = {}
+
+        # Segment pairs read from converted translation memories, written as they are converted
+        self.tm_file = None
+        self.tm_count = 0
+
+        # Optionally upload the text of PDF files instead of the PDF files themselves
+        self.extract_pdf = extract_pdf
+        self.pdf_mode = pdf_mode
+
+        # Glob patterns, relative to the output directory, selecting the files to sync
+        self.include = include or []
+        self.exclude = exclude or []
+        self.scan_workers = max(1, scan_workers)
+
+        # Maximum number of files waiting between the scan, conversion and upload stages
+        self.queue_size = max(1, queue_size)
 
-        # Check for missing variables
-        if not self.OPENAI_API_KEY:
+        # Identical files are always uploaded once; text files at least this similar (MinHash
+        # estimate of the Jaccard similarity of their word shingles) are also uploaded once
+        self.near_duplicate_threshold = near_duplicate_threshold
+
+        # Chunks of the converted files can also be embedded into a local index, searched without the API
+        self.local_index = LocalIndex(self.LOCAL_INDEX_DIR, index_dtype)
+        self.embedder_name = embedder
+
+        # Optional approximate index over the local one, probing more lists or re-scoring more
+        # candidates trades latency for recall
+        self.ann_index = IVFPQIndex(self.local_index, ann_lists, probes=max(1, ann_probes), rerank=max(0, ann_rerank)) if ann else None
+
+        # Check for missing variables, offline runs never call the API
+        if not self.OPENAI_API_KEY and not offline:
             raise ValueError("API key not found. Please set the OPENAI_API_KEY environment variable.")
 
         # Initialize OpenAI client with the API key from environment variable
-        self.client = OpenAI(api_key=self.OPENAI_API_KEY)
+        self.client = None if offline else OpenAI(api_key=self.OPENAI_API_KEY)
 
         # Define the name for the vector store
         self.vector_store_name = f"Test APE"
@@ -31,131 +1568,605 @@ class FilesToAssistant:
         # Define the name of the assistant
         self.assistant_name = f"RAG for APE"
 
-    def convert_xlsx_to_txt(self, xlsx_path):
+        # Define the instructions and model used when the assistant is created
+        self.assistant_instructions = "You are a helpful assistant specializing in automated post-editing based on the provided translation files. Your primary objective is to enhance the clarity, precision, and flow of the text during the post-editing process. All edits should be made as accurately as possible, strictly according to the provided translation files. If translation is also required, first perform the automated post-editing on the original text using the provided files, then translate the edited text into the specified language (e.g., Text. (language)). Do not rely on prior knowledge or external information—focus exclusively on refining the provided content. Ensure that both the post-edited and translated versions reflect these improvements."
+        self.assistant_model = "gpt-4o-mini"
+
+    def is_convertible(self, path):
+        # PDF files are only converted when local extraction is enabled
+        suffix = path.suffix.lower()
+        return suffix in CONVERTERS and (suffix != ".pdf" or self.extract_pdf)
+
+    def submit_conversion(self, path, executor):
+        suffix = path.suffix.lower()
+        converter = CONVERTERS[suffix]
+
+        # The extraction mode changes the text of PDF files, so it is part of their cache key
+        namespace = f"pdf-{self.pdf_mode}" if suffix == ".pdf" else suffix.lstrip(".")
         try:
-            # Load the Excel file
-            xls = pd.ExcelFile(xlsx_path)
-            txt_files = []
+            # Reuse the output of files whose content was already converted
+            sha256 = hash_file(path)
+            cached = self.conversion_cache.lookup(namespace, sha256)
+            if cached is not None:
+                print(f"Reusing cached conversion of {path}")
+                return path, converter, namespace, sha256, None, cached
+
+            # Large files are streamed instead of being loaded in memory
+            options = {"streaming": path.stat().st_size >= self.streaming_threshold_bytes, "pdf_mode": self.pdf_mode}
 
-            # Iterate over each sheet and save as a separate TXT file
-            for sheet_name in xls.sheet_names:
-                df = pd.read_excel(xls, sheet_name=sheet_name)
+            # Parsing is CPU bound, so every part of every file is converted in its own process
+            staging = self.conversion_cache.staging_dir(namespace, sha256)
+            jobs = []
+            for part in converter.parts(path):
+                txt_path = staging / ("text.txt" if part is None else f"{part}.txt")
+                jobs.append((part, txt_path, executor.submit(convert_part, suffix, path, part, txt_path, options)))
+            return path, converter, namespace, sha256, staging, jobs
+        except Exception as e:
+            print(f"Error converting {path} to TXT: {e}")
+            return path, converter, namespace, None, None, None
+
+    def finish_conversion(self, path, converter, namespace, sha256, staging, outputs):
+        if staging is not None:
+            outputs = self.collect_conversion(path, namespace, sha256, staging, outputs)
+
+        # Files that failed or have no text are uploaded as is when the vector store accepts them
+        if not outputs:
+            if outputs is not None:
+                print(f"No text extracted from {path}, {'uploading it as is' if converter.upload_raw_if_empty else 'skipping it'}.")
+            return [path] if converter.upload_raw_if_empty else []
+
+        # Converted files are uploaded under names derived from their source, and tracked in
+        # the manifest under its path
+        key = self.manifest_key(path)
+        links = []
+        for txt_path in outputs:
+            name = f"{path.stem}.txt" if txt_path.name == "text.txt" else f"{path.stem}_{txt_path.name}"
+            link_path = self.conversion_cache.link(txt_path, key, name)
+            self.converted_keys[link_path] = f"{key}/{name}"
+            links.append(link_path)
+        outputs = links
 
-                # Define the TXT path for each sheet
-                txt_path = xlsx_path.with_name(f"{xlsx_path.stem}_{sheet_name}.txt")
-                
-                # Save the sheet content as TXT
-                df.to_csv(txt_path, sep='\t', index=False)
-                print(f"Converted {xlsx_path} - Sheet '{sheet_name}' to {txt_path}")
+        # Spreadsheets with language columns also feed the glossary
+        if path.suffix.lower() in GLOSSARY_SUFFIXES:
+            for txt_path in outputs:
+                try:
+                    sheet = read_glossary_sheet(txt_path)
+                    if sheet and sheet["terms"]:
+                        self.glossary_sheets[self.manifest_key(txt_path)] = sheet
+                except Exception as e:
+                    print(f"Error reading glossary {txt_path}: {e}")
 
-                txt_files.append(txt_path)
+        # Translation memories feed the fuzzy matcher used before running the assistant
+        if path.suffix.lower() in TM_SUFFIXES:
+            if self.tm_file is None:
+                self.tm_file = self.TM_PATH.with_name(self.TM_PATH.name + ".tmp").open("w", encoding="utf-8")
+            for txt_path in outputs:
+                try:
+                    for record in iter_tm_records(txt_path):
+                        self.tm_file.write(json.dumps(dict(record, file=self.manifest_key(txt_path)), ensure_ascii=False) + "\n")
+                        self.tm_count += 1
+                except Exception as e:
+                    print(f"Error reading translation memory {txt_path}: {e}")
+        return outputs
+
+    def collect_conversion(self, path, namespace, sha256, staging, jobs):
+        outputs = []
+        for part, txt_path, future in jobs:
+            source = path if part is None else f"{path} - Sheet '{part}'"
+            try:
+                characters = future.result()
+            except Exception as e:
+                print(f"Error converting {source} to TXT: {e}")
+                shutil.rmtree(staging, ignore_errors=True)
+                return None
 
-            return txt_files
-        
+            # Empty parts are not uploaded
+            if not characters:
+                txt_path.unlink(missing_ok=True)
+                continue
+            print(f"Converted {source} to TXT")
+            outputs.append(txt_path.name)
+
+        # Only files whose parts were all converted are cached
+        try:
+            return self.conversion_cache.commit(namespace, sha256, staging, outputs)
         except Exception as e:
-            print(f"Error converting {xlsx_path} to TXT: {e}")
-            return []
+            print(f"Error caching the conversion of {path}: {e}")
+            shutil.rmtree(staging, ignore_errors=True)
+            return None
 
-    def process_files(self):
-        # Get list of all files in output_dir directory
-        file_paths = [path for path in self.OUTPUT_DIR.iterdir() if path.is_file()]
-        txt_files = []
-        non_xlsx_files = []
-
-        # Convert .xlsx files to .txt and collect other files
-        for path in file_paths:
-            if path.suffix == '.xlsx':
-                txt_files.extend(self.convert_xlsx_to_txt(path))
-            else:
-                non_xlsx_files.append(path)
+    def manifest_key(self, path):
+        # Identify files by their path relative to the output directory
+        if path in self.converted_keys:
+            return self.converted_keys[path]
+        try:
+            return path.relative_to(self.OUTPUT_DIR).as_posix()
+        except ValueError:
+            return path.as_posix()
+
+    def iter_files_to_upload(self):
+        # Scan, convert and hand out upload-ready files through bounded queues, so the first
+        # uploads start while later files are still being scanned and converted
+        scanned = queue.Queue(maxsize=self.queue_size)
+        ready = queue.Queue(maxsize=self.queue_size)
+
+        def scan():
+            # Get all files in output_dir directory and its subdirectories
+            try:
+                for path in scan_files(
+                    self.OUTPUT_DIR, self.include, self.exclude, self.scan_workers, skip=[self.MANIFEST_PATH, self.GLOSSARY_PATH, self.TM_PATH, self.CACHE_DIR, self.LOCAL_INDEX_DIR]
+                ):
+                    scanned.put(path)
+            except Exception as e:
+                print(f"Error scanning {self.OUTPUT_DIR}: {e}")
+            finally:
+                scanned.put(None)
+
+        def convert():
+            # Convert spreadsheets, translation memories and documents to compact text,
+            # one TXT file per sheet for workbooks, and pass the other files through
+            scanning = True
+            try:
+                # Worker processes are started from a fresh server process, forking this one
+                # while the scan and upload threads run could deadlock them
+                with ProcessPoolExecutor(max_workers=self.convert_workers, mp_context=conversion_context()) as executor:
+                    # Keep a bounded window of files being converted and hand them out in order
+                    in_flight = deque()
+                    for path in iter(scanned.get, None):
+                        if not self.is_convertible(path):
+                            ready.put(path)
+                            continue
+                        in_flight.append(self.submit_conversion(path, executor))
+                        if len(in_flight) > 2 * self.convert_workers:
+                            for output in self.finish_conversion(*in_flight.popleft()):
+                                ready.put(output)
+                    scanning = False
+                    while in_flight:
+                        for output in self.finish_conversion(*in_flight.popleft()):
+                            ready.put(output)
+            except Exception as e:
+                print(f"Error converting files: {e}")
 
-        # Combine txt files and non-xlsx files for upload
-        all_files_to_upload = txt_files + non_xlsx_files
+                # Keep taking scanned files so the scan never blocks on a full queue and can be joined
+                if scanning:
+                    for _ in iter(scanned.get, None):
+                        pass
+            finally:
+                ready.put(None)
+
+        stages = [threading.Thread(target=scan, daemon=True), threading.Thread(target=convert, daemon=True)]
+        for stage in stages:
+            stage.start()
+        yield from iter(ready.get, None)
+        for stage in stages:
+            stage.join()
+
+        self.save_glossary()
+        self.save_translation_memory()
+
+        # Keep the conversion cache within its size budget
+        try:
+            self.conversion_cache.evict()
+        except Exception as e:
+            print(f"Error evicting conversion cache {self.CACHE_DIR}: {e}")
+
+    def save_glossary(self):
+        try:
+            tmp_path = self.GLOSSARY_PATH.with_name(self.GLOSSARY_PATH.name + ".tmp")
+            with tmp_path.open("w", encoding="utf-8") as f:
+                json.dump({"version": 1, "sheets": self.glossary_sheets}, f, ensure_ascii=False)
+            tmp_path.replace(self.GLOSSARY_PATH)
+            terms = sum(len(sheet["terms"]) for sheet in self.glossary_sheets.values())
+            print(f"Saved {terms} glossary terms from {len(self.glossary_sheets)} sheets to {self.GLOSSARY_PATH}")
+        except Exception as e:
+            print(f"Error saving glossary {self.GLOSSARY_PATH}: {e}")
+
+    def save_translation_memory(self):
+        try:
+            if self.tm_file is None:
+                self.tm_file = self.TM_PATH.with_name(self.TM_PATH.name + ".tmp").open("w", encoding="utf-8")
+            self.tm_file.close()
+            Path(self.tm_file.name).replace(self.TM_PATH)
+            print(f"Saved {self.tm_count} translation memory segments to {self.TM_PATH}")
+        except Exception as e:
+            print(f"Error saving translation memory {self.TM_PATH}: {e}")
+        finally:
+            self.tm_file = None
+            self.tm_count = 0
+
+    def lookup_glossary(self, text, target_language=None):
+        hits = GlossaryIndex.load(self.GLOSSARY_PATH).find(text, target_language)
+        print(f"{len(hits)} glossary hits in '{text}':")
+        for hit in hits:
+            targets = ", ".join(f"{target} ({language})" for language, target in hit["translations"].items())
+            print(f"{hit['start']}-{hit['end']} {hit['text']} -> {targets} [{hit['file']}]")
+        return hits
+
+    def process_files(self):
+        # Run the whole scan and conversion pipeline and collect its output
+        all_files_to_upload = list(self.iter_files_to_upload())
+        txt_files = [path for path in all_files_to_upload if path in self.converted_keys]
         return all_files_to_upload, txt_files
 
+    def build_local_index(self):
+        embedder = EMBEDDERS[self.embedder_name](self.client)
+        info = self.local_index.open_for_append(embedder)
+        local_keys = set()
+        indexed_keys = []
+
+        def iter_documents():
+            # Chunk every new or changed text file, converted ones included, other files cannot be read locally
+            for path in self.iter_files_to_upload():
+                if path.suffix.lower() not in TEXT_SUFFIXES:
+                    print(f"Skipping {path}, only text files are indexed locally.")
+                    continue
+                key = self.manifest_key(path)
+                local_keys.add(key)
+                try:
+                    sha256 = hash_file(path)
+                    if self.local_index.is_indexed(info, key, sha256):
+                        continue
+                    chunks = [{"key": key, "chunk": number, "text": text} for number, text in enumerate(iter_text_chunks(path))]
+                except Exception as e:
+                    print(f"Error chunking file {path}: {e}")
+                    continue
+                indexed_keys.append(key)
+                yield key, sha256, chunks
+
+        # Append the new chunks to the index in place, readers keep using it meanwhile
+        self.local_index.append(info, iter_documents(), embedder)
+        self.conversion_cache.evict()
+
+        # Forget files removed from disk, and rewrite the index once most of its rows are dead
+        removed_keys = [key for key in info["documents"] if key not in local_keys]
+        if removed_keys:
+            self.local_index.forget(info, removed_keys)
+        live_count = sum(document["stop"] - document["start"] for document in info["documents"].values())
+        if info["count"] > 2 * live_count:
+            info = self.local_index.compact(info)
+        if self.ann_index is not None:
+            self.ann_index.update(info)
+        print(
+            f"Indexed {len(indexed_keys)} new or changed files, {len(removed_keys)} removed, "
+            f"{live_count} chunks in {self.LOCAL_INDEX_DIR} with embedder '{embedder.name}'."
+        )
+
+    def search_local_index(self, query, top_k=5):
+        embedder = EMBEDDERS[self.embedder_name](self.client)
+        hits = self.local_index.search(query, embedder, top_k, self.ann_index)
+        print(f"Top {len(hits)} chunks for '{query}':")
+        for hit in hits:
+            text = " ".join(hit["text"].split())
+            print(f"{hit['score']:.3f} {hit['key']}#{hit['chunk']}: {text[:200]}")
+        return hits
+
+    def benchmark_local_index(self, queries=100, top_k=5):
+        # Compare the approximate index with exact search, using stored chunks as queries
+        info = self.local_index.load_info()
+        if info is None or self.ann_index is None:
+            raise ValueError("Benchmarking needs a local index built with --local --ann.")
+        live = np.flatnonzero(self.local_index.live_rows(info))
+        rows = np.random.default_rng(0).choice(live, min(queries, len(live)), replace=False)
+        vectors = np.asarray(self.local_index.open_matrix(info)[np.sort(rows)], dtype=np.float32)
+
+        started = time.perf_counter()
+        expected = [set(self.local_index.nearest(info, vector, top_k)[0].tolist()) for vector in vectors]
+        exact_ms = (time.perf_counter() - started) * 1000 / len(vectors)
+        print(f"Exact search: {exact_ms:.2f} ms/query over {len(live)} chunks")
+
+        probes = self.ann_index.probes
+        lists = self.ann_index.load_info()["lists"]
+        for tried_probes in sorted({1, 2, 4, 8, 16, 32, probes} & set(range(1, lists + 1))):
+            self.ann_index.probes = tried_probes
+            started = time.perf_counter()
+            found = [set(self.ann_index.nearest(info, vector, top_k)[0].tolist()) for vector in vectors]
+            ann_ms = (time.perf_counter() - started) * 1000 / len(vectors)
+            recall = sum(len(f & e) for f, e in zip(found, expected)) / max(1, sum(len(e) for e in expected))
+            print(f"ANN {tried_probes} of {lists} lists, rerank {self.ann_index.rerank}: recall@{top_k} {recall:.3f}, {ann_ms:.2f} ms/query")
+        self.ann_index.probes = probes
+
     def upload_files_to_vectorstorage(self):
         # List all vector stores to check if one with the same name already exists
-        existing_vector_stores = self.client.beta.vector_stores.list()
-        vector_store_id = None
+        vector_store_id = self.existing_vector_store_id(self.client.beta.vector_stores.list().data)
 
-        for vector_store_data in existing_vector_stores.data:
-            if vector_store_data.name == self.vector_store_name:
-                vector_store_id = vector_store_data.id
-                break
+        # If a vector store with the same name exists and rebuild is set, delete it
+        if vector_store_id and self.rebuild:
+            self.client.beta.vector_stores.delete(vector_store_id)
+            print(f"Deleted vector store with ID {vector_store_id}")
+            vector_store_id = None
 
-        # If a vector store with the same name exists and overwrite is set, delete it
+        # Reuse the existing vector store or create a new one
         if vector_store_id:
-            if self.overwrite:
-                print(f"Vector store with name '{self.vector_store_name}' already exists. Deleting it...")
-                self.client.beta.vector_stores.delete(vector_store_id)
-                print(f"Deleted vector store with ID {vector_store_id}")
-            else:
-                print(f"Vector store with name '{self.vector_store_name}' already exists. Use --overwrite to delete it.")
-                return
+            self.vector_store = self.client.beta.vector_stores.retrieve(vector_store_id)
+        else:
+            self.vector_store = self.client.beta.vector_stores.create(name=self.vector_store_name)
 
-        # Create a new vector store
-        self.vector_store = self.client.beta.vector_stores.create(name=self.vector_store_name)
+        sync = SyncState(UploadManifest(self.MANIFEST_PATH))
 
-        # Process files (conversion + deletion) and get the list of files to upload
-        files_to_upload, txt_files = self.process_files()
-        file_streams = []
+        # Scan, convert, hash and upload as a stream: each batch is uploaded and attached as soon
+        # as it is full, and the manifest is saved after each one so an interrupted run resumes
+        # from the first incomplete batch
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for batch in self.iter_sync_batches(sync.manifest, sync.local_keys, sync.duplicate_files, sync.stale_files):
+                # Files unknown to the manifest may still have been uploaded by an older run
+                if sync.remote_index is None and self.needs_remote_index(batch, sync.manifest):
+                    sync.remote_index = RemoteFileIndex(self.client.files.list())
+                self.record_changed_batch(sync, batch)
 
-        # Try to open each file and handle any errors
-        for path in files_to_upload:
-            try:
-                filename = path.name
+                sync.uploaded_files += self.upload_batch(executor, sync.manifest, batch)
+                sync.progress.update(batch)
 
-                # Check if the file already exists in OpenAI storage
-                existing_files = self.client.files.list()
-                for f in existing_files.data:
-                    if filename in f.filename:
-                        print(f"File with base name '{filename}' already exists. Deleting it...")
-                        self.client.files.delete(f.id)
-                        print(f"Deleted file with ID {f.id}")
+        # Detach and delete removed files and replaced versions
+        deleted_files = self.finish_sync(sync)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(lambda stale: self.delete_remote_file(*stale), deleted_files))
 
-                # Open the file for upload, excluding .xlsx files
-                if path.suffix != '.xlsx':
-                    file_streams.append(path.open("rb"))
+        self.save_manifest(sync.manifest)
 
-            except Exception as e:
-                print(f"Error opening file {path}: {e}")
+    def existing_vector_store_id(self, vector_stores):
+        # The vector store named like ours, if any, saying what this sync will do with it
+        for vector_store_data in vector_stores:
+            if vector_store_data.name == self.vector_store_name:
+                if self.rebuild:
+                    print(f"Vector store with name '{self.vector_store_name}' already exists. Deleting it...")
+                elif self.overwrite:
+                    print(f"Vector store with name '{self.vector_store_name}' already exists. Mirroring local files into it...")
+                else:
+                    print(f"Vector store with name '{self.vector_store_name}' already exists. Syncing changed files into it (use --overwrite to also remove deleted files).")
+                return vector_store_data.id
+        return None
 
-        # Upload and poll the files, and add them to the vector store
-        if file_streams:
-            file_batch = self.client.beta.vector_stores.file_batches.upload_and_poll(
-                vector_store_id=self.vector_store.id, files=file_streams
-            )
+    def record_changed_batch(self, sync, batch):
+        # Previous versions of the changed files are deleted once the sync is over
+        sync.changed_count += len(batch)
+        stale_files, orphan_files = self.collect_stale_files(batch, [], sync.manifest, sync.remote_index)
+        sync.stale_files += stale_files
+        sync.orphan_files += orphan_files
 
-            # Check the status
-            print(f"File batch status: {file_batch.status}")
-            print(f"File counts: {file_batch.file_counts}")
-        else:
-            print("No files were successfully opened and uploaded.")
+    def finish_sync(self, sync):
+        # The remote files to delete: removed files, replaced versions and orphaned uploads
+        removed_keys = self.removed_keys(sync.manifest, sync.local_keys)
+        sync.orphan_files += self.collect_stale_files([], removed_keys, sync.manifest, None)[1]
+        print(f"{sync.changed_count} of {len(sync.local_keys)} files changed since the last sync, {len(removed_keys)} removed.")
+        return self.record_sync(sync.manifest, sync.changed_count, removed_keys, sync.uploaded_files, sync.duplicate_files, sync.stale_files) + sync.orphan_files
 
-        # Close the file streams after processing
-        for stream in file_streams:
+    def upload_batch(self, executor, manifest, batch):
+        batch_files = []
+        futures = [executor.submit(self.upload_pending_file, manifest, path, key, sha256) for path, key, _, sha256 in batch]
+        for (path, key, stat, sha256), future in zip(batch, futures):
             try:
-                stream.close()
+                batch_files.append((key, stat, sha256, future.result()))
             except Exception as e:
-                print(f"Error closing file stream: {e}")
+                print(f"Error uploading file {path}: {e}")
+        self.save_manifest(manifest)
 
-        # Delete the .txt files created during the conversion
-        for txt_file in txt_files:
+        # Add the uploaded files to the vector store and poll until they are processed
+        if batch_files:
             try:
-                txt_file.unlink()
-                print(f"Deleted the temporary TXT file: {txt_file}")
+                file_batch = self.client.beta.vector_stores.file_batches.create_and_poll(
+                    vector_store_id=self.vector_store.id, file_ids=[file_id for _, _, _, file_id in batch_files]
+                )
+                return self.record_batch(manifest, file_batch, batch_files)
             except Exception as e:
-                print(f"Error deleting TXT file {txt_file}: {e}")
+                print(f"Error adding files to vector store {self.vector_store.id}: {e}")
+        return []
 
-    def update_assistant(self):
-        # Fetch an existing Assistant (assuming you have the assistant ID)
-        assistants = self.client.beta.assistants.list()
-        assistant_id = None
+    def iter_sync_batches(self, manifest, local_keys, duplicate_files, stale_files):
+        changed_files = self.iter_changed_files(self.iter_files_to_upload(), manifest, local_keys, duplicate_files)
+        yield from self.iter_batches(changed_files)
+
+        # Duplicates are resolved once every original was added: they share the file of their
+        # original, or are uploaded after all if the original could not be added
+        leftover_files = self.record_duplicates(manifest, duplicate_files, stale_files)
+        yield from self.iter_batches(leftover_files)
+
+    def iter_changed_files(self, files_to_upload, manifest, local_keys, duplicate_files):
+        # Contents already in the vector store or uploaded by this run, with the name they are uploaded under
+        owners_by_content = manifest.keys_by_content(self.vector_store.id)
+        near_duplicates = self.near_duplicate_index(manifest) if self.near_duplicate_threshold else None
+
+        # Only yield the files whose content is not already in the vector store
+        for path in files_to_upload:
+            try:
+                key = self.manifest_key(path)
+                local_keys.add(key)
+                stat = path.stat()
+                sha256 = manifest.file_hash(key, path, stat)
+                if manifest.is_synced(key, sha256, self.vector_store.id):
+                    # Refresh size and mtime so the file is not hashed again next time
+                    entry = manifest.entries[key]
+                    manifest.record(key, stat, sha256, entry["file_id"], entry["vector_store_id"])
+                    continue
+
+                # The same content is already uploaded under another name
+                owner = owners_by_content.get(sha256)
+                if owner and owner != key:
+                    duplicate_files.append((path, key, stat, sha256, owner, sha256))
+                    continue
+
+                # Nearly the same text is already uploaded under another name
+                if near_duplicates is not None and path.suffix.lower() in TEXT_SUFFIXES:
+                    signature = minhash_signature(path)
+                    if signature is not None:
+                        owner = near_duplicates.find(signature)
+                        if owner and owner != key:
+                            # Every indexed owner has its signature recorded with the content it was computed from
+                            duplicate_files.append((path, key, stat, sha256, owner, manifest.minhashes[owner]["sha256"]))
+                            continue
+                        near_duplicates.add(key, signature)
+                        manifest.minhashes[key] = {"sha256": sha256, "signature": signature.tolist()}
+
+                owners_by_content[sha256] = key
+                yield path, key, stat, sha256
+            except Exception as e:
+                print(f"Error reading file {path}: {e}")
+
+    def near_duplicate_index(self, manifest):
+        # Index the signatures of the text files whose recorded content is in the vector store
+        index = MinHashIndex(self.near_duplicate_threshold)
+        for key, minhash in manifest.minhashes.items():
+            if manifest.is_synced(key, minhash["sha256"], self.vector_store.id):
+                index.add(key, np.array(minhash["signature"], dtype=np.uint64))
+        return index
+
+    def record_duplicates(self, manifest, duplicate_files, stale_files):
+        leftover_files = []
+        shared_count = 0
+        for path, key, stat, sha256, owner, owner_sha256 in duplicate_files:
+            # Share the file of the original only if it was added with the content it was compared with
+            if not manifest.is_synced(owner, owner_sha256, self.vector_store.id):
+                leftover_files.append((path, key, stat, sha256))
+                continue
+            entry = manifest.entries[owner]
+
+            # The previous version of this file and any upload left by an interrupted run become stale
+            previous = manifest.entries.get(key)
+            if previous and previous.get("file_id") and previous["file_id"] != entry["file_id"]:
+                stale_files.append((key, previous))
+            if key in manifest.pending:
+                stale_files.append((key, manifest.pending.pop(key)))
+            manifest.minhashes.pop(key, None)
+            manifest.record(key, stat, sha256, entry["file_id"], self.vector_store.id)
+            shared_count += 1
+
+        if shared_count:
+            print(f"Skipped {shared_count} duplicate files, they share the file already uploaded for their original.")
+            self.save_manifest(manifest)
+        return leftover_files
+
+    def removed_keys(self, manifest, local_keys):
+        # Files synced by a previous run but no longer on disk
+        if not (self.overwrite or self.rebuild):
+            return []
+        return [key for key in manifest.entries if key not in local_keys]
+
+    def iter_batches(self, changed_files):
+        # Group the files into batches bounded both in file count and in total size
+        batch = []
+        batch_bytes = 0
+        for changed_file in changed_files:
+            size = changed_file[2].st_size
+            if batch and (len(batch) >= self.batch_files or batch_bytes + size > self.batch_bytes):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(changed_file)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    def needs_remote_index(self, changed_files, manifest):
+        return any(not manifest.entries.get(key, {}).get("file_id") for _, key, _, _ in changed_files)
+
+    def collect_stale_files(self, changed_files, removed_keys, manifest, remote_index):
+        # Collect the previous remote version of each changed file, it is only deleted
+        # once the new version is in the vector store so the store never goes empty
+        stale_files = []
+        known_file_ids = {entry["file_id"] for entry in list(manifest.entries.values()) + list(manifest.pending.values())}
+        for path, key, stat, sha256 in changed_files:
+            entry = manifest.entries.get(key)
+            if entry and entry.get("file_id"):
+                stale_files.append((key, entry))
+            elif remote_index is not None:
+                for file_id in remote_index.find(path.name):
+                    if file_id not in known_file_ids:
+                        stale_files.append((key, {"file_id": file_id, "vector_store_id": None}))
 
-        for assistant_data in assistants.data:
+        # Uploads left by an interrupted run that can no longer be reused are always deleted
+        orphan_files = []
+        changed_by_key = {key: sha256 for _, key, _, sha256 in changed_files}
+        for key in list(manifest.pending):
+            sha256 = changed_by_key.get(key)
+            if key in removed_keys or (sha256 and not manifest.pending_file_id(key, sha256, self.vector_store.id)):
+                orphan_files.append((key, manifest.pending.pop(key)))
+        return stale_files, orphan_files
+
+    def reusable_file_id(self, manifest, key, sha256):
+        # The upload an interrupted run already made of this exact content, if any
+        file_id = manifest.pending_file_id(key, sha256, self.vector_store.id)
+        if file_id:
+            print(f"Reusing file with ID {file_id} uploaded by a previous run for '{key}'")
+        return file_id
+
+    def upload_pending_file(self, manifest, path, key, sha256):
+        file_id = self.reusable_file_id(manifest, key, sha256)
+        if file_id:
+            return file_id
+        file_id = with_retries(self.upload_file, path)
+        manifest.record_pending(key, sha256, file_id, self.vector_store.id)
+        return file_id
+
+    def record_batch(self, manifest, file_batch, batch_files):
+        # Check the status
+        print(f"File batch status: {file_batch.status}")
+        print(f"File counts: {file_batch.file_counts}")
+        if file_batch.status != "completed":
+            # Keep the files pending so the next run attaches them again without re-uploading
+            return []
+
+        # Remember what was synced so the next run can skip it
+        for key, stat, sha256, file_id in batch_files:
+            manifest.record(key, stat, sha256, file_id, self.vector_store.id)
+        self.save_manifest(manifest)
+        return batch_files
+
+    def record_sync(self, manifest, changed_count, removed_keys, uploaded_files, duplicate_files, stale_files):
+        if uploaded_files:
+            print(f"Added {len(uploaded_files)} files to vector store {self.vector_store.id}.")
+        elif changed_count:
+            print("No files were successfully opened and uploaded.")
+        elif not (removed_keys or duplicate_files):
+            print("Vector store is already up to date.")
+
+        # Only replace previous versions of files that were actually re-uploaded or now share a file
+        uploaded_keys = {key for key, _, _, _ in uploaded_files}
+        uploaded_keys |= {key for _, key, _, sha256, _, _ in duplicate_files if manifest.is_synced(key, sha256, self.vector_store.id)}
+        stale_files = [(key, entry) for key, entry in stale_files if key in uploaded_keys]
+
+        # Removed files are forgotten by the manifest and deleted remotely
+        for key in removed_keys:
+            stale_files.append((key, manifest.entries.pop(key)))
+            manifest.minhashes.pop(key, None)
+
+        # A file shared by several names is only deleted once no name refers to it anymore
+        referenced_file_ids = manifest.referenced_file_ids()
+        deleted_files = {}
+        for key, entry in stale_files:
+            if entry["file_id"] not in referenced_file_ids:
+                deleted_files.setdefault(entry["file_id"], (key, entry))
+        return list(deleted_files.values())
+
+    def save_manifest(self, manifest):
+        try:
+            manifest.save()
+        except Exception as e:
+            print(f"Error saving manifest {self.MANIFEST_PATH}: {e}")
+
+    def upload_file(self, path):
+        # Open the file only for the duration of its own upload, once a handle slot is free
+        with self.open_files, path.open("rb") as stream:
+            return self.client.files.create(file=stream, purpose="assistants").id
+
+    def delete_remote_file(self, name, entry):
+        try:
+            # Detach the file from the vector store first so it stops being searched right away
+            if entry.get("vector_store_id") == self.vector_store.id:
+                with_retries(self.client.beta.vector_stores.files.delete, file_id=entry["file_id"], vector_store_id=self.vector_store.id)
+            print(f"Deleting remote file for '{name}'...")
+            with_retries(self.client.files.delete, entry["file_id"])
+            print(f"Deleted file with ID {entry['file_id']}")
+        except Exception as e:
+            print(f"Error deleting file {entry['file_id']}: {e}")
+
+    def find_assistant_id(self):
+        # Fetch an existing Assistant by name
+        for assistant_data in self.client.beta.assistants.list().data:
             if assistant_data.name == self.assistant_name:
-                assistant_id = assistant_data.id
-                break
+                return assistant_data.id
+        return None
+
+    def update_assistant(self):
+        assistant_id = self.find_assistant_id()
 
         if assistant_id:
             # Update the Assistant to Use the New Vector Store
@@ -168,8 +2179,8 @@ class FilesToAssistant:
             # Create a new Assistant if it doesn't exist
             assistant = self.client.beta.assistants.create(
                 name=self.assistant_name,
-                instructions="You are a helpful assistant specializing in automated post-editing based on the provided translation files. Your primary objective is to enhance the clarity, precision, and flow of the text during the post-editing process. All edits should be made as accurately as possible, strictly according to the provided translation files. If translation is also required, first perform the automated post-editing on the original text using the provided files, then translate the edited text into the specified language (e.g., Text. (language)). Do not rely on prior knowledge or external information—focus exclusively on refining the provided content. Ensure that both the post-edited and translated versions reflect these improvements.",
-                model="gpt-4o-mini",
+                instructions=self.assistant_instructions,
+                model=self.assistant_model,
                 tools=[{"type": "file_search"}],
             )
 
@@ -180,15 +2191,703 @@ class FilesToAssistant:
             )
             print(f"Created and updated assistant '{assistant.name}' with new vector store.")
 
+    def run_assistant_id(self):
+        assistant_id = self.find_assistant_id()
+        if not assistant_id:
+            raise ValueError(f"Assistant '{self.assistant_name}' not found, sync the files first to create it.")
+        return assistant_id
+
+    def load_glossary(self):
+        # Glossary hits are added to the prompt of each segment when a glossary was built
+        return GlossaryIndex.load(self.GLOSSARY_PATH) if self.GLOSSARY_PATH.exists() else None
+
+    def segment_cache_context(self, assistant_id):
+        # Cached results are only valid for the same instructions, model and vector stores
+        assistant = self.client.beta.assistants.retrieve(assistant_id)
+        file_search = getattr(assistant.tool_resources, "file_search", None) if assistant.tool_resources else None
+        vector_store_ids = sorted(getattr(file_search, "vector_store_ids", None) or [])
+        return json.dumps([assistant.instructions, assistant.model, vector_store_ids])
+
+    def submit_segment(self, executor, segment, prompt, run, target_language=None):
+        # Translation memory matches at or above the threshold are served as they are
+        if run.matcher is not None:
+            started = time.monotonic()
+            match = run.matcher.match(segment["source"], run.tm_threshold, target_language or segment.get("target_language"), segment.get("source_language"))
+            if match:
+                run.stats.tm_matches += 1
+                return completed_future((match[0]["target"], time.monotonic() - started, None))
+
+        # The cache is read before submitting, so hits never wait behind running segments
+        cache_key = None
+        if run.cache is not None:
+            cache_key = hashlib.sha256(f"{run.cache_context}\n{normalize_segment(prompt)}".encode("utf-8")).hexdigest()
+            started = time.monotonic()
+            cached = run.cache.get(cache_key)
+            if cached is not None:
+                run.stats.cached += 1
+                return completed_future((cached, time.monotonic() - started, None))
+
+        # Short segments wait to be sent together, the pack being sent once it is full
+        tokens = estimate_tokens(json.dumps(self.pack_entry(segment, 0, target_language), ensure_ascii=False))
+        if run.pack_tokens and tokens <= run.pack_tokens // 2:
+            pack_tokens = sum(item[4] for item in run.pack)
+            if len(run.pack) >= run.pack_segments or pack_tokens + tokens > run.pack_tokens:
+                self.flush_pack(executor, run, target_language)
+            future = Future()
+            run.pack.append((segment, prompt, cache_key, future, tokens))
+            return future
+        return executor.submit(self.cached_post_edit, run, cache_key, prompt)
+
+    def cached_post_edit(self, run, cache_key, prompt):
+        result = run.post_edit(run.assistant_id, prompt)
+        if result[0] and cache_key:
+            run.cache.put(cache_key, result[0])
+        return result
+
+    def flush_pack(self, executor, run, target_language=None):
+        if run.pack:
+            executor.submit(self.post_edit_pack, executor, list(run.pack), run, target_language)
+            run.pack.clear()
+
+    def pack_entry(self, segment, number, target_language=None):
+        entry = {"id": str(number), "source": segment["source"]}
+        if segment["target"]:
+            entry["machine_translation"] = segment["target"]
+        if target_language or segment.get("target_language"):
+            entry["target_language"] = target_language or segment["target_language"]
+        return entry
+
+    def pack_prompt(self, segments, glossary=None, target_language=None):
+        # Segments are numbered in the pack, so their ids are short and never collide
+        entries = [self.pack_entry(segment, number, target_language) for number, segment in enumerate(segments, 1)]
+        lines = [
+            "Post-edit each segment below: its machine translation when it has one, otherwise its source text.",
+            'Answer with a single JSON object mapping every segment id to its post-edited text, like {"1": "...", "2": "..."}, and nothing else.',
+            json.dumps(entries, ensure_ascii=False),
+        ]
+        terms = []
+        for segment in segments if glossary else []:
+            for line in glossary.prompt(segment["source"], target_language or segment.get("target_language")).splitlines():
+                if line not in terms:
+                    terms.append(line)
+        if terms:
+            lines.append("Use these glossary translations:\n" + "\n".join(terms))
+        return "\n".join(lines)
+
+    def post_edit_pack(self, executor, items, run, target_language=None):
+        run.stats.packs += 1
+        prompt = self.pack_prompt([segment for segment, *_ in items], run.glossary, target_language)
+        post_edits = {}
+        latency, first_token = None, None
+        try:
+            text, latency, first_token = run.post_edit(run.assistant_id, prompt)
+            post_edits = parse_pack_response(text)
+        except Exception as e:
+            print(f"Error post-editing a pack of {len(items)} segments, running them one by one: {e}")
+
+        # Segments missing from the answer, or all of them when it could not be read, are run alone
+        for number, (segment, segment_prompt, cache_key, future, _) in enumerate(items, 1):
+            post_edit = post_edits.get(str(number))
+            if post_edit:
+                if cache_key:
+                    run.cache.put(cache_key, post_edit)
+                future.set_result((post_edit, latency, first_token))
+            else:
+                run.stats.unpacked += 1
+                single = executor.submit(self.cached_post_edit, run, cache_key, segment_prompt)
+                single.add_done_callback(lambda single, future=future: forward_future(single, future))
+
+    def run_segments(
+        self,
+        input_path,
+        output_path,
+        concurrency=8,
+        target_language=None,
+        stream=False,
+        cache_ttl_days=30,
+        cache_max_segments=100000,
+        tm_threshold=1.0,
+        pack_tokens=0,
+        pack_segments=50,
+    ):
+        assistant_id = self.run_assistant_id()
+        glossary = self.load_glossary()
+        stats = RunStats()
+
+        # Segments found in the translation memories do not need the assistant
+        matcher = None
+        if tm_threshold is not None and self.TM_PATH.exists():
+            matcher = FuzzyMatcher.load(self.TM_PATH)
+            print(f"Loaded {len(matcher.records)} translation memory segments, serving matches of at least {tm_threshold:.0%}")
+
+        # Repeated segments are answered from a persistent cache without running the assistant
+        cache = None
+        cache_context = None
+        if cache_max_segments > 0:
+            cache = SegmentCache(self.SEGMENT_CACHE_PATH, cache_ttl_days * 86400, cache_max_segments)
+            cache_context = self.segment_cache_context(assistant_id)
+        post_edit = self.stream_post_edit_segment if stream else self.post_edit_segment
+        run = RunContext(assistant_id, post_edit, glossary, cache, cache_context, matcher, tm_threshold, pack_tokens, max(1, pack_segments), [], stats)
+
+        # Packed segments are answered a pack at a time, so the window holds whole packs
+        window = 2 * concurrency * (run.pack_segments if pack_tokens else 1)
+        print(f"Post-editing {input_path} with assistant '{self.assistant_name}', {concurrency} segments at a time...")
+
+        # Keep a bounded window of segments in flight and write their results in input order,
+        # each one as soon as it and every segment before it are done
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor, output_path.open("w", encoding="utf-8", newline="") as output:
+                if output_path.suffix.lower() != ".jsonl":
+                    output.write(tsv_line(["id", "source", "target", "post_edit"]))
+                in_flight = deque()
+                for segment in iter_segments(input_path):
+                    prompt = self.post_edit_prompt(segment, glossary, target_language)
+                    in_flight.append((segment, self.submit_segment(executor, segment, prompt, run, target_language)))
+                    if len(in_flight) >= window:
+                        # Never wait for a segment of the pack still being filled
+                        if run.pack and in_flight[0][1] is run.pack[0][3]:
+                            self.flush_pack(executor, run, target_language)
+                        self.write_post_edit(output, *in_flight.popleft(), stats)
+                    while in_flight and in_flight[0][1].done():
+                        self.write_post_edit(output, *in_flight.popleft(), stats)
+                self.flush_pack(executor, run, target_language)
+                while in_flight:
+                    self.write_post_edit(output, *in_flight.popleft(), stats)
+        finally:
+            if cache is not None:
+                cache.close()
+        stats.report()
+        print(f"Wrote post-edited segments to {output_path}")
+
+    def post_edit_prompt(self, segment, glossary=None, target_language=None):
+        target_language = target_language or segment.get("target_language")
+        if segment["target"]:
+            lines = [
+                "Post-edit the machine translation of the source text below. Answer with the post-edited translation only.",
+                f"Source: {segment['source']}",
+                f"Machine translation: {segment['target']}",
+            ]
+        else:
+            lines = ["Post-edit the text below. Answer with the post-edited text only.", f"Text: {segment['source']}"]
+        if target_language:
+            lines.append(f"Target language: {target_language}")
+
+        # Glossary terms are given verbatim so the assistant does not have to find them by search
+        terms = glossary.prompt(segment["source"], target_language) if glossary else ""
+        if terms:
+            lines.append(f"Use these glossary translations:\n{terms}")
+        return "\n".join(lines)
+
+    def post_edit_segment(self, assistant_id, prompt):
+        # Each segment gets its own thread, deleted once the answer is read
+        started = time.monotonic()
+        run = with_retries(
+            self.client.beta.threads.create_and_run_poll,
+            assistant_id=assistant_id,
+            thread={"messages": [{"role": "user", "content": prompt}]},
+        )
+        try:
+            if run.status != "completed":
+                raise RuntimeError(f"Run {run.id} ended with status {run.status}")
+            messages = with_retries(self.client.beta.threads.messages.list, thread_id=run.thread_id, run_id=run.id)
+            text = "".join(
+                part.text.value
+                for message in messages.data if message.role == "assistant"
+                for part in message.content if part.type == "text"
+            )
+        finally:
+            try:
+                self.client.beta.threads.delete(run.thread_id)
+            except Exception as e:
+                print(f"Error deleting thread {run.thread_id}: {e}")
+        return text.strip(), time.monotonic() - started, None
+
+    def stream_post_edit_segment(self, assistant_id, prompt, on_text=None):
+        # Stream the run instead of polling it, so text is received as soon as it is generated
+        started = time.monotonic()
+        first_token = None
+        thread = with_retries(self.client.beta.threads.create, messages=[{"role": "user", "content": prompt}])
+        try:
+            parts = []
+            with self.client.beta.threads.runs.stream(thread_id=thread.id, assistant_id=assistant_id) as stream:
+                for delta in stream.text_deltas:
+                    if first_token is None:
+                        first_token = time.monotonic() - started
+                    parts.append(delta)
+                    if on_text:
+                        on_text(delta)
+                run = stream.get_final_run()
+            if run.status != "completed":
+                raise RuntimeError(f"Run {run.id} ended with status {run.status}")
+        finally:
+            try:
+                self.client.beta.threads.delete(thread.id)
+            except Exception as e:
+                print(f"Error deleting thread {thread.id}: {e}")
+        return "".join(parts).strip(), time.monotonic() - started, first_token
+
+    def chat_segments(self, target_language=None):
+        assistant_id = self.run_assistant_id()
+        glossary = self.load_glossary()
+        print("Enter a segment, or a source and its machine translation separated by a tab. An empty line quits.")
+        while True:
+            try:
+                line = input("> ")
+            except EOFError:
+                break
+            if not line.strip():
+                break
+
+            # Print the post-edited text token by token as the run streams it
+            source, _, target = line.partition("\t")
+            segment = {"id": "", "source": source.strip(), "target": target.strip(), "target_language": ""}
+            prompt = self.post_edit_prompt(segment, glossary, target_language)
+            try:
+                _, latency, first_token = self.stream_post_edit_segment(assistant_id, prompt, lambda delta: print(delta, end="", flush=True))
+                print(f"\n({first_token or latency:.2f}s to first token, {latency:.2f}s in total)")
+            except Exception as e:
+                print(f"\nError post-editing segment: {e}")
+
+    def batch_segments(
+        self,
+        input_path,
+        output_path,
+        target_language=None,
+        tm_threshold=1.0,
+        poll_seconds=60,
+        max_requests=BATCH_MAX_REQUESTS,
+        max_bytes=BATCH_MAX_BYTES,
+    ):
+        # The Batch API runs chat completions, not assistants, so the assistant's instructions
+        # and model are reused without file search
+        assistant = self.client.beta.assistants.retrieve(self.run_assistant_id())
+        glossary = self.load_glossary()
+        matcher = FuzzyMatcher.load(self.TM_PATH) if tm_threshold is not None and self.TM_PATH.exists() else None
+        segments = list(iter_segments(input_path))
+        stats = RunStats()
+
+        # One request per segment not found in the translation memories, identified by its position in the input
+        tm_results = {}
+        requests = []
+        for index, segment in enumerate(segments):
+            match = matcher.match(segment["source"], tm_threshold, target_language or segment.get("target_language"), segment.get("source_language")) if matcher else None
+            if match:
+                stats.tm_matches += 1
+                tm_results[index] = match[0]["target"]
+                continue
+            body = {
+                "model": assistant.model,
+                "messages": [
+                    {"role": "system", "content": assistant.instructions or ""},
+                    {"role": "user", "content": self.post_edit_prompt(segment, glossary, target_language)},
+                ],
+            }
+            requests.append({"custom_id": f"segment-{index}", "method": "POST", "url": "/v1/chat/completions", "body": body})
+        requests_paths = self.write_batch_requests(requests, output_path, max_requests, max_bytes)
+
+        # Submit every request file before waiting, so the batches run at the same time. The ids of
+        # submitted batches are kept next to the output, so an interrupted run resumes them
+        state_path = output_path.with_name(f"{output_path.name}.batch.json")
+        batch_ids = json.loads(state_path.read_text(encoding="utf-8")).get("batches", {}) if state_path.exists() else {}
+        batches = [self.submit_batch(requests_path, batch_ids, state_path, input_path) for requests_path in requests_paths]
+
+        # Batches of request files that changed since an earlier run are never resumed
+        batch_ids = {requests_hash: batch_ids[requests_hash] for requests_hash, _ in batches}
+        results, errors = {}, {}
+        incomplete = False
+        for requests_hash, batch in batches:
+            batch = self.wait_for_batch(batch, poll_seconds)
+            batch_results, batch_errors = self.read_batch_results(batch)
+            results.update(batch_results)
+            errors.update(batch_errors)
+
+            # Batches that did not complete are submitted again on the next run
+            if batch.status != "completed":
+                batch_ids.pop(requests_hash)
+                incomplete = True
+
+        # Collate the results back into input order, batch latency being the time until the batches ended
+        latency = time.monotonic() - stats.started
+        with output_path.open("w", encoding="utf-8", newline="") as output:
+            if output_path.suffix.lower() != ".jsonl":
+                output.write(tsv_line(["id", "source", "target", "post_edit"]))
+            for index, segment in enumerate(segments):
+                custom_id = f"segment-{index}"
+                if index in tm_results:
+                    future = completed_future((tm_results[index], 0.0, None))
+                elif results.get(custom_id):
+                    future = completed_future((results[custom_id], latency, None))
+                else:
+                    future = failed_future(RuntimeError(errors.get(custom_id, "no result in the batch output")))
+                self.write_post_edit(output, segment, future, stats)
+        if incomplete:
+            state_path.write_text(json.dumps({"batches": batch_ids}), encoding="utf-8")
+        else:
+            state_path.unlink(missing_ok=True)
+        stats.report()
+        print(f"Wrote post-edited segments to {output_path}")
+
+    def write_batch_requests(self, requests, output_path, max_requests=BATCH_MAX_REQUESTS, max_bytes=BATCH_MAX_BYTES):
+        # Split the requests into numbered files, each within the limits of one batch
+        for stale_path in output_path.parent.glob(f"{glob.escape(output_path.name)}.batch-*.jsonl"):
+            stale_path.unlink()
+        requests_paths = []
+        requests_file = None
+        try:
+            for request in requests:
+                line = (json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8")
+                if requests_file is None or file_requests >= max_requests or file_bytes + len(line) > max_bytes:
+                    if requests_file is not None:
+                        requests_file.close()
+                    requests_paths.append(output_path.with_name(f"{output_path.name}.batch-{len(requests_paths) + 1}.jsonl"))
+                    requests_file = requests_paths[-1].open("wb")
+                    file_requests, file_bytes = 0, 0
+                requests_file.write(line)
+                file_requests += 1
+                file_bytes += len(line)
+        finally:
+            if requests_file is not None:
+                requests_file.close()
+        return requests_paths
+
+    def submit_batch(self, requests_path, batch_ids, state_path, input_path):
+        # A batch submitted for the same requests by an interrupted run is polled again instead of resubmitted
+        requests_hash = hashlib.sha256(requests_path.read_bytes()).hexdigest()
+        if requests_hash in batch_ids:
+            print(f"Resuming batch {batch_ids[requests_hash]} for {requests_path}")
+            return requests_hash, with_retries(self.client.batches.retrieve, batch_ids[requests_hash])
+
+        batch_file = with_retries(self.client.files.create, file=(requests_path.name, requests_path.read_bytes()), purpose="batch")
+        batch = with_retries(
+            self.client.batches.create,
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+            metadata={"input": str(input_path)[-512:]},
+        )
+        batch_ids[requests_hash] = batch.id
+        state_path.write_text(json.dumps({"batches": batch_ids}), encoding="utf-8")
+        print(f"Submitted batch {batch.id} from {requests_path}")
+        return requests_hash, batch
+
+    def wait_for_batch(self, batch, poll_seconds=60):
+        # Poll until the batch ends, expired batches still have the results completed in time
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            counts = batch.request_counts
+            print(f"Batch {batch.id} is {batch.status}" + (f", {counts.completed + counts.failed} of {counts.total} requests done" if counts else ""))
+            time.sleep(poll_seconds)
+            batch = with_retries(self.client.batches.retrieve, batch.id)
+        for error in getattr(batch.errors, "data", None) or []:
+            print(f"Error in batch {batch.id}: {error.message}")
+        print(f"Batch {batch.id} is {batch.status}")
+        return batch
+
+    def read_batch_results(self, batch):
+        results, errors = {}, {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in with_retries(self.client.files.content, file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code") == 200:
+                    results[result["custom_id"]] = (response["body"]["choices"][0]["message"]["content"] or "").strip()
+                else:
+                    error = result.get("error") or (response.get("body") or {}).get("error") or {}
+                    errors[result["custom_id"]] = error.get("message") or f"request ended with status {response.get('status_code')}"
+        return results, errors
+
+    def write_post_edit(self, output, segment, future, stats):
+        try:
+            post_edit, latency, first_token = future.result()
+            error = None
+        except Exception as e:
+            print(f"Error post-editing segment {segment['id']}: {e}")
+            post_edit, latency, first_token, error = "", None, None, str(e)
+        stats.update(latency, first_token)
+
+        # JSONL output keeps every field of the segment, TSV output one row per segment
+        if output.name.lower().endswith(".jsonl"):
+            output.write(json.dumps(dict(segment, post_edit=post_edit, error=error), ensure_ascii=False) + "\n")
+        else:
+            output.write(tsv_line([segment["id"], segment["source"], segment["target"], post_edit]))
+        output.flush()
+
+class AsyncFilesToAssistant(FilesToAssistant):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # A single async client shares its connection pool between all concurrent requests
+        self.client = AsyncOpenAI(api_key=self.OPENAI_API_KEY)
+        self.semaphore = asyncio.Semaphore(self.workers)
+        self.open_files = asyncio.BoundedSemaphore(self.max_open_files)
+
+    async def upload_files_to_vectorstorage(self):
+        # List all vector stores to check if one with the same name already exists
+        vector_store_id = self.existing_vector_store_id([v async for v in self.client.beta.vector_stores.list()])
+
+        # If a vector store with the same name exists and rebuild is set, delete it
+        if vector_store_id and self.rebuild:
+            await self.client.beta.vector_stores.delete(vector_store_id)
+            print(f"Deleted vector store with ID {vector_store_id}")
+            vector_store_id = None
+
+        # Reuse the existing vector store or create a new one
+        if vector_store_id:
+            self.vector_store = await self.client.beta.vector_stores.retrieve(vector_store_id)
+        else:
+            self.vector_store = await self.client.beta.vector_stores.create(name=self.vector_store_name)
+
+        sync = SyncState(UploadManifest(self.MANIFEST_PATH))
+
+        # Scan, convert, hash and upload as a stream: each batch is uploaded and attached as soon
+        # as it is full, and the manifest is saved after each one so an interrupted run resumes
+        # from the first incomplete batch
+        batches = self.iter_sync_batches(sync.manifest, sync.local_keys, sync.duplicate_files, sync.stale_files)
+        while True:
+            # Scanning, conversion and hashing are local work, keep them off the event loop
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                break
+
+            # Files unknown to the manifest may still have been uploaded by an older run
+            if sync.remote_index is None and self.needs_remote_index(batch, sync.manifest):
+                sync.remote_index = RemoteFileIndex([f async for f in self.client.files.list()])
+            self.record_changed_batch(sync, batch)
+
+            sync.uploaded_files += await self.upload_batch(sync.manifest, batch)
+            sync.progress.update(batch)
+
+        # Detach and delete removed files and replaced versions
+        deleted_files = self.finish_sync(sync)
+        await asyncio.gather(*(self.delete_remote_file(key, entry) for key, entry in deleted_files))
+
+        self.save_manifest(sync.manifest)
+
+    async def upload_batch(self, manifest, batch):
+        batch_files = []
+        results = await asyncio.gather(*(self.upload_pending_file(manifest, path, key, sha256) for path, key, _, sha256 in batch), return_exceptions=True)
+        for (path, key, stat, sha256), result in zip(batch, results):
+            if isinstance(result, Exception):
+                print(f"Error uploading file {path}: {result}")
+            else:
+                batch_files.append((key, stat, sha256, result))
+        self.save_manifest(manifest)
+
+        # Add the uploaded files to the vector store and poll until they are processed
+        if batch_files:
+            try:
+                file_batch = await self.client.beta.vector_stores.file_batches.create_and_poll(
+                    vector_store_id=self.vector_store.id, file_ids=[file_id for _, _, _, file_id in batch_files]
+                )
+                return self.record_batch(manifest, file_batch, batch_files)
+            except Exception as e:
+                print(f"Error adding files to vector store {self.vector_store.id}: {e}")
+        return []
+
+    async def upload_pending_file(self, manifest, path, key, sha256):
+        file_id = self.reusable_file_id(manifest, key, sha256)
+        if file_id:
+            return file_id
+        file_id = await async_with_retries(self.upload_file, path)
+        manifest.record_pending(key, sha256, file_id, self.vector_store.id)
+        return file_id
+
+    async def upload_file(self, path):
+        # Open the file only for the duration of its own upload, once a request and a handle slot
+        # are free, and let the client stream it instead of holding the whole file in memory
+        async with self.semaphore, self.open_files:
+            with path.open("rb") as stream:
+                uploaded = await self.client.files.create(file=stream, purpose="assistants")
+            return uploaded.id
+
+    async def delete_remote_file(self, name, entry):
+        async with self.semaphore:
+            try:
+                # Detach the file from the vector store first so it stops being searched right away
+                if entry.get("vector_store_id") == self.vector_store.id:
+                    await async_with_retries(self.client.beta.vector_stores.files.delete, file_id=entry["file_id"], vector_store_id=self.vector_store.id)
+                print(f"Deleting remote file for '{name}'...")
+                await async_with_retries(self.client.files.delete, entry["file_id"])
+                print(f"Deleted file with ID {entry['file_id']}")
+            except Exception as e:
+                print(f"Error deleting file {entry['file_id']}: {e}")
+
+    async def update_assistant(self):
+        # Fetch an existing Assistant by name
+        assistant_id = None
+        async for assistant_data in self.client.beta.assistants.list():
+            if assistant_data.name == self.assistant_name:
+                assistant_id = assistant_data.id
+                break
+
+        if assistant_id:
+            # Update the Assistant to Use the New Vector Store
+            assistant = await self.client.beta.assistants.update(
+                assistant_id=assistant_id,
+                tool_resources={"file_search": {"vector_store_ids": [self.vector_store.id]}},
+            )
+            print(f"Updated assistant '{assistant.name}' with new vector store.")
+        else:
+            # Create a new Assistant if it doesn't exist, already using the vector store
+            assistant = await self.client.beta.assistants.create(
+                name=self.assistant_name,
+                instructions=self.assistant_instructions,
+                model=self.assistant_model,
+                tools=[{"type": "file_search"}],
+                tool_resources={"file_search": {"vector_store_ids": [self.vector_store.id]}},
+            )
+            print(f"Created and updated assistant '{assistant.name}' with new vector store.")
+
+async def main_async(options):
+    confluence_assistant = AsyncFilesToAssistant(**options)
+    try:
+        # Upload files to vector storage
+        await confluence_assistant.upload_files_to_vectorstorage()
+
+        # Update assistant with the vector store
+        await confluence_assistant.update_assistant()
+    finally:
+        await confluence_assistant.client.close()
+
 def main():
 
     # Set up command-line argument parsing
     parser = argparse.ArgumentParser(description="Export files to VS.")
-    parser.add_argument("--overwrite", action="store_true", help="Overwrite existing vector store if it exists")
+    parser.add_argument("--overwrite", action="store_true", help="Mirror local files into the existing vector store, removing deleted ones")
+    parser.add_argument("--rebuild", action="store_true", help="Delete the existing vector store and rebuild it from scratch")
+    parser.add_argument("--workers", type=int, default=8, help="Number of concurrent uploads and deletions")
+    parser.add_argument("--batch-files", type=int, default=100, help="Maximum number of files added to the vector store per batch")
+    parser.add_argument("--batch-mb", type=float, default=100, help="Maximum total size in MB of the files added per batch")
+    parser.add_argument("--max-open-files", type=int, default=64, help="Maximum number of local files open at the same time during upload")
+    parser.add_argument("--convert-workers", type=int, default=None, help="Number of processes converting files to text (default: one per CPU)")
+    parser.add_argument("--streaming-threshold-mb", type=float, default=20, help="Stream Excel files at least this large (in MB) row by row instead of loading them with pandas")
+    parser.add_argument("--cache-max-mb", type=float, default=1024, help="Maximum size in MB of the conversion cache")
+    parser.add_argument("--extract-pdf", action="store_true", help="Extract the text of PDF files locally and upload it instead of the PDF files")
+    parser.add_argument("--pdf-mode", choices=["plain", "layout"], default="plain", help="Text extraction mode used with --extract-pdf")
+    parser.add_argument("--include", action="append", metavar="PATTERN", help="Only sync files whose path relative to OUTPUT_DIR matches this glob (repeatable)")
+    parser.add_argument("--exclude", action="append", metavar="PATTERN", help="Skip files and directories whose path relative to OUTPUT_DIR matches this glob (repeatable)")
+    parser.add_argument("--scan-workers", type=int, default=4, help="Number of threads scanning subdirectories of OUTPUT_DIR")
+    parser.add_argument("--near-duplicates", type=float, default=None, metavar="THRESHOLD", help="Also upload only once text files whose estimated similarity is at least THRESHOLD (e.g. 0.9)")
+    parser.add_argument("--local", action="store_true", help="Chunk and embed the files into a local index instead of syncing the OpenAI vector store")
+    parser.add_argument("--embedder", choices=sorted(EMBEDDERS), default="hashing", help="Embedder used by the local index (hashing works offline)")
+    parser.add_argument("--index-dtype", choices=["float16", "float32"], default="float16", help="Precision of the embeddings stored in the local index")
+    parser.add_argument("--query", action="append", help="Search the local index for this text and print the best chunks (repeatable)")
+    parser.add_argument("--top-k", type=int, default=5, help="Number of chunks printed per --query")
+    parser.add_argument("--ann", action="store_true", help="Maintain an approximate (IVF-PQ) index with --local and search it with --query")
+    parser.add_argument("--ann-lists", type=int, default=None, help="Number of IVF lists (default: square root of the number of chunks)")
+    parser.add_argument("--ann-probes", type=int, default=8, help="Number of IVF lists searched per query, more is slower but finds more")
+    parser.add_argument("--ann-rerank", type=int, default=100, help="Number of approximate matches re-scored exactly per query")
+    parser.add_argument("--benchmark", type=int, default=0, metavar="QUERIES", help="Compare recall and latency of the approximate index with exact search on this many queries")
+    parser.add_argument("--lookup", action="append", metavar="TEXT", help="Print the glossary terms found in this text (repeatable)")
+    parser.add_argument("--target-lang", default=None, help="Only show glossary translations into this language, e.g. fr or fr-FR")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="Run the whole sync on the asynchronous OpenAI client")
+
+    # Subcommands, syncing the vector store stays the default
+    subparsers = parser.add_subparsers(dest="command")
+    run_parser = subparsers.add_parser("run", help="Post-edit segments through the assistant")
+    run_parser.add_argument("input", type=Path, help="Segments to post-edit: .tsv, .jsonl, .xliff or .xlf file")
+    run_parser.add_argument("-o", "--output", type=Path, default=None, help="Output file, .jsonl or .tsv (default: INPUT.ape.tsv)")
+    run_parser.add_argument("--concurrency", type=int, default=8, help="Number of segments post-edited at the same time")
+    run_parser.add_argument("--target-lang", default=argparse.SUPPRESS, help="Language of the post-edited output, when the input does not say")
+    run_parser.add_argument("--cache-ttl-days", type=float, default=30, help="Reuse cached post-edits of identical segments for this many days")
+    run_parser.add_argument("--cache-max-segments", type=int, default=100000, help="Maximum number of cached post-edits, least recently used ones are evicted first")
+    run_parser.add_argument("--no-cache", action="store_true", help="Always run the assistant, without reading or writing the segment cache")
+    run_parser.add_argument("--tm-threshold", type=float, default=1.0, help="Serve translation memory matches at least this similar without the assistant, 1 for exact matches only, e.g. 0.9 for high fuzzy matches too")
+    run_parser.add_argument("--no-tm", action="store_true", help="Never serve translation memory matches")
+    run_parser.add_argument("--pack-tokens", type=int, default=0, help="Send short segments together in runs of up to this many estimated tokens (0 runs every segment alone)")
+    run_parser.add_argument("--pack-segments", type=int, default=50, help="Maximum number of segments sent in one packed run")
+    run_parser.add_argument("--stream", action="store_true", help="Stream each run instead of polling it until it completes")
+    batch_parser = subparsers.add_parser("batch", help="Post-edit segments offline through the Batch API, waiting for the whole batch")
+    batch_parser.add_argument("input", type=Path, help="Segments to post-edit: .tsv, .jsonl, .xliff or .xlf file")
+    batch_parser.add_argument("-o", "--output", type=Path, default=None, help="Output file, .jsonl or .tsv (default: INPUT.ape.tsv)")
+    batch_parser.add_argument("--target-lang", default=argparse.SUPPRESS, help="Language of the post-edited output, when the input does not say")
+    batch_parser.add_argument("--tm-threshold", type=float, default=1.0, help="Serve translation memory matches at least this similar without sending them")
+    batch_parser.add_argument("--no-tm", action="store_true", help="Never serve translation memory matches")
+    batch_parser.add_argument("--max-requests", type=int, default=BATCH_MAX_REQUESTS, help="Maximum number of segments sent in one batch, larger inputs are split into several batches")
+    batch_parser.add_argument("--poll-seconds", type=float, default=60, help="Seconds between two checks of the batch status")
+    chat_parser = subparsers.add_parser("chat", help="Post-edit segments typed interactively, streaming the answers")
+    chat_parser.add_argument("--target-lang", default=argparse.SUPPRESS, help="Language of the post-edited output")
     args = parser.parse_args()
 
+    # Options shared by the synchronous and asynchronous pipelines
+    options = dict(
+        overwrite=args.overwrite,
+        rebuild=args.rebuild,
+        workers=args.workers,
+        batch_files=args.batch_files,
+        batch_mb=args.batch_mb,
+        max_open_files=args.max_open_files,
+        convert_workers=args.convert_workers,
+        streaming_threshold_mb=args.streaming_threshold_mb,
+        cache_max_mb=args.cache_max_mb,
+        extract_pdf=args.extract_pdf,
+        pdf_mode=args.pdf_mode,
+        include=args.include,
+        exclude=args.exclude,
+        scan_workers=args.scan_workers,
+        near_duplicate_threshold=args.near_duplicates,
+        embedder=args.embedder,
+        index_dtype=args.index_dtype,
+        ann=args.ann or bool(args.benchmark),
+        ann_lists=args.ann_lists,
+        ann_probes=args.ann_probes,
+        ann_rerank=args.ann_rerank,
+    )
+
+    # Post-edit segments with the assistant created by a previous sync
+    if args.command == "run":
+        runner = FilesToAssistant(**options)
+        runner.run_segments(
+            args.input,
+            args.output or args.input.with_name(f"{args.input.stem}.ape.tsv"),
+            args.concurrency,
+            args.target_lang,
+            args.stream,
+            args.cache_ttl_days,
+            0 if args.no_cache else args.cache_max_segments,
+            None if args.no_tm else args.tm_threshold,
+            args.pack_tokens,
+            args.pack_segments,
+        )
+        return
+    if args.command == "batch":
+        FilesToAssistant(**options).batch_segments(
+            args.input,
+            args.output or args.input.with_name(f"{args.input.stem}.ape.tsv"),
+            args.target_lang,
+            None if args.no_tm else args.tm_threshold,
+            args.poll_seconds,
+            args.max_requests,
+        )
+        return
+    if args.command == "chat":
+        FilesToAssistant(**options).chat_segments(args.target_lang)
+        return
+
+    # Build and search the local index, without the API unless embedding with OpenAI
+    if args.local or args.query or args.benchmark or args.lookup:
+        local_assistant = FilesToAssistant(**options, offline=args.embedder == "hashing")
+        if args.local:
+            local_assistant.build_local_index()
+        for query in args.query or []:
+            local_assistant.search_local_index(query, args.top_k)
+        if args.benchmark:
+            local_assistant.benchmark_local_index(args.benchmark, args.top_k)
+        for text in args.lookup or []:
+            local_assistant.lookup_glossary(text, args.target_lang)
+        return
+
+    # Run the asynchronous pipeline instead of the synchronous one
+    if args.use_async:
+        asyncio.run(main_async(options))
+        return
+
     # Instantiate the FilesToAssistant class with the overwrite argument
-    confluence_assistant = FilesToAssistant(overwrite=args.overwrite)
+    confluence_assistant = FilesToAssistant(**options)
 
     # Upload files to vector storage
     confluence_assistant.upload_files_to_vectorstorage()
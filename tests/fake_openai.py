@@ -0,0 +1,141 @@
+import json
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAI(ThreadingHTTPServer):
+    # A local stand-in for the assistants, files and batches endpoints used by the batch subcommand.
+    # Batches complete after a few polls, answering each chat completion with answer(prompt), and
+    # requests whose prompt contains "FAIL" end with an error. Batches listed in failing_batches fail as a whole.
+
+    def __init__(self, assistants=None, polls_until_done=2, answer=lambda prompt: f"[post-edited] {prompt.splitlines()[-1]}"):
+        super().__init__(("127.0.0.1", 0), FakeOpenAIHandler)
+        self.assistants = assistants or []
+        self.polls_until_done = polls_until_done
+        self.answer = answer
+        self.files = {}
+        self.batches = {}
+        self.failing_batches = set()
+        self.lock = threading.RLock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_port}/v1"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+    def add_file(self, filename, content, purpose):
+        with self.lock:
+            file_id = f"file-{len(self.files) + 1}"
+            self.files[file_id] = {"filename": filename, "content": content, "purpose": purpose}
+        return {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()), "filename": filename, "purpose": purpose, "status": "processed"}
+
+    def run_batch(self, batch):
+        if batch["id"] in self.failing_batches:
+            batch["errors"] = {"object": "list", "data": [{"code": "fake_failure", "message": "The fake server failed this batch", "line": None, "param": None}]}
+            batch["status"] = "failed"
+            return
+
+        # Answer every request of the input file, successes and errors going to separate files
+        outputs, errors = [], []
+        for line in self.files[batch["input_file_id"]]["content"].decode("utf-8").splitlines():
+            request = json.loads(line)
+            prompt = request["body"]["messages"][-1]["content"]
+            if "FAIL" in prompt:
+                error = {"error": {"message": "The fake server refused this request", "type": "invalid_request_error"}}
+                errors.append({"id": f"req-{len(errors)}", "custom_id": request["custom_id"], "response": {"status_code": 400, "body": error}, "error": None})
+            else:
+                completion = {"id": "chatcmpl-fake", "object": "chat.completion", "model": request["body"]["model"], "choices": [{"index": 0, "message": {"role": "assistant", "content": self.answer(prompt)}, "finish_reason": "stop"}]}
+                outputs.append({"id": f"req-{len(outputs)}", "custom_id": request["custom_id"], "response": {"status_code": 200, "body": completion}, "error": None})
+
+        # Results come back in no particular order, the client has to collate them
+        outputs.reverse()
+        batch["output_file_id"] = self.add_file("output.jsonl", "".join(json.dumps(o) + "\n" for o in outputs).encode("utf-8"), "batch_output")["id"] if outputs else None
+        batch["error_file_id"] = self.add_file("errors.jsonl", "".join(json.dumps(e) + "\n" for e in errors).encode("utf-8"), "batch_output")["id"] if errors else None
+        batch["request_counts"] = {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)}
+        batch["status"] = "completed"
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        server = self.server
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts == ["v1", "assistants"]:
+            return self.send_json({"object": "list", "data": server.assistants, "first_id": None, "last_id": None, "has_more": False})
+        if parts[:2] == ["v1", "assistants"] and len(parts) == 3:
+            for assistant in server.assistants:
+                if assistant["id"] == parts[2]:
+                    return self.send_json(assistant)
+        if parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content" and parts[2] in server.files:
+            content = server.files[parts[2]]["content"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        if parts[:2] == ["v1", "batches"] and len(parts) == 3 and parts[2] in server.batches:
+            with server.lock:
+                batch = server.batches[parts[2]]
+                batch["polls"] += 1
+                if batch["status"] == "in_progress" and batch["polls"] >= server.polls_until_done:
+                    server.run_batch(batch)
+                return self.send_json({key: value for key, value in batch.items() if key != "polls"})
+        self.send_json({"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}}, 404)
+
+    def do_POST(self):
+        server = self.server
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts == ["v1", "files"]:
+            # Multipart upload with a purpose field and a file field
+            message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8") + self.read_body())
+            fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+            upload = fields["file"]
+            return self.send_json(server.add_file(upload.get_filename(), upload.get_payload(decode=True), fields["purpose"].get_content().strip()))
+        if parts == ["v1", "batches"]:
+            request = json.loads(self.read_body())
+            if request["input_file_id"] not in server.files:
+                return self.send_json({"error": {"message": "No such file", "type": "invalid_request_error"}}, 400)
+            with server.lock:
+                batch_id = f"batch-{len(server.batches) + 1}"
+                server.batches[batch_id] = {
+                    "id": batch_id,
+                    "object": "batch",
+                    "endpoint": request["endpoint"],
+                    "input_file_id": request["input_file_id"],
+                    "completion_window": request["completion_window"],
+                    "status": "in_progress",
+                    "created_at": int(time.time()),
+                    "metadata": request.get("metadata"),
+                    "request_counts": {"total": 0, "completed": 0, "failed": 0},
+                    "output_file_id": None,
+                    "error_file_id": None,
+                    "errors": None,
+                    "polls": 0,
+                }
+                return self.send_json({key: value for key, value in server.batches[batch_id].items() if key != "polls"})
+        self.send_json({"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}}, 404)
@@ -0,0 +1,103 @@
+import csv
+import json
+
+import pytest
+
+from ape_test import FilesToAssistant
+from fake_openai import FakeOpenAI
+
+ASSISTANT = {
+    "id": "asst-1",
+    "object": "assistant",
+    "created_at": 0,
+    "name": "RAG for APE",
+    "model": "gpt-4o-mini",
+    "instructions": "Post-edit.",
+    "tools": [{"type": "file_search"}],
+    "metadata": {},
+}
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    with FakeOpenAI([ASSISTANT]) as server:
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setenv("OPENAI_API_KEY", "test")
+        monkeypatch.setenv("OPENAI_BASE_URL", server.base_url)
+        monkeypatch.setenv("OUTPUT_DIR", str(tmp_path / "Docs"))
+        yield server
+
+
+def write_segments(path, rows):
+    path.write_text("".join(f"{source}\t{target}\n" for source, target in rows), encoding="utf-8")
+
+
+def read_post_edits(path):
+    with path.open(encoding="utf-8", newline="") as f:
+        return [row["post_edit"] for row in csv.DictReader(f, delimiter="\t")]
+
+
+def test_batch_splits_requests_and_collates_results_in_input_order(server, tmp_path):
+    input_path = tmp_path / "segments.tsv"
+    output_path = tmp_path / "segments.ape.tsv"
+    rows = [(f"Source {number}", f"Machine translation {number}") for number in range(7)]
+    rows[4] = ("Source 4", "FAIL")
+    write_segments(input_path, rows)
+
+    FilesToAssistant(False).batch_segments(input_path, output_path, None, None, poll_seconds=0, max_requests=3)
+
+    # Seven requests at most three per batch, answered out of order, one of them failing
+    assert len(server.batches) == 3
+    expected = [f"[post-edited] Machine translation: {target}" for _, target in rows]
+    expected[4] = ""
+    assert read_post_edits(output_path) == expected
+    assert sorted(path.name for path in tmp_path.glob("segments.ape.tsv.batch-*.jsonl")) == [
+        "segments.ape.tsv.batch-1.jsonl",
+        "segments.ape.tsv.batch-2.jsonl",
+        "segments.ape.tsv.batch-3.jsonl",
+    ]
+
+    # Every batch completed, so nothing is left to resume
+    assert not (tmp_path / "segments.ape.tsv.batch.json").exists()
+
+
+def test_batch_resumes_batches_submitted_by_an_interrupted_run(server, tmp_path):
+    input_path = tmp_path / "segments.tsv"
+    output_path = tmp_path / "segments.ape.tsv"
+    write_segments(input_path, [(f"Source {number}", f"Machine translation {number}") for number in range(4)])
+
+    # Interrupt the first run while it is polling
+    runner = FilesToAssistant(False)
+
+    def wait_for_batch(batch, poll_seconds=60):
+        raise KeyboardInterrupt
+
+    runner.wait_for_batch = wait_for_batch
+    with pytest.raises(KeyboardInterrupt):
+        runner.batch_segments(input_path, output_path, None, None, poll_seconds=0, max_requests=2)
+    assert len(server.batches) == 2
+    assert (tmp_path / "segments.ape.tsv.batch.json").exists()
+
+    # The next run polls the same batches instead of submitting new ones
+    FilesToAssistant(False).batch_segments(input_path, output_path, None, None, poll_seconds=0, max_requests=2)
+    assert len(server.batches) == 2
+    assert read_post_edits(output_path) == [f"[post-edited] Machine translation: Machine translation {number}" for number in range(4)]
+
+
+def test_batch_keeps_completed_batches_when_another_one_fails(server, tmp_path):
+    input_path = tmp_path / "segments.tsv"
+    output_path = tmp_path / "segments.ape.tsv"
+    state_path = tmp_path / "segments.ape.tsv.batch.json"
+    write_segments(input_path, [(f"Source {number}", f"Machine translation {number}") for number in range(4)])
+
+    # A batch left by an earlier run with other requests is forgotten, a failed one is submitted again
+    state_path.write_text(json.dumps({"batches": {"stale": "batch-0"}}), encoding="utf-8")
+    server.failing_batches.add("batch-2")
+    FilesToAssistant(False).batch_segments(input_path, output_path, None, None, poll_seconds=0, max_requests=2)
+    assert read_post_edits(output_path)[2:] == ["", ""]
+    assert list(json.loads(state_path.read_text(encoding="utf-8"))["batches"].values()) == ["batch-1"]
+
+    FilesToAssistant(False).batch_segments(input_path, output_path, None, None, poll_seconds=0, max_requests=2)
+    assert len(server.batches) == 3
+    assert read_post_edits(output_path) == [f"[post-edited] Machine translation: Machine translation {number}" for number in range(4)]
+    assert not state_path.exists()